@@ -1,8 +1,6 @@
 import importlib.util
 import subprocess
 import sys
-import json
-from orgwide_instances_utils import *
 
 
 def main(command_line=None):
@@ -11,14 +9,19 @@ def main(command_line=None):
         print("boto3 is not installed")
         print("Installing boto3")
         subprocess.call([sys.executable, '-m', 'pip', 'install', 'boto3'])
+        importlib.invalidate_caches()
 
+    # boto3 and the stage modules are imported only once boto3 is known to be installed; every stage then
+    # runs in this process and shares the inputs, clients and caches held by the pipeline context
     try:
-        import boto3
+        from orgwide_instances_utils import check_if_delegated_admin, get_cf_client
+        from orgwide_instances_pipeline import PipelineContext, run_stage, CREATE_ROLES_STAGE, AGGREGATOR_STAGE
     except ImportError:
         print("Error importing boto3")
         exit()
 
-    inputs = get_inputs()
+    context = PipelineContext.from_inputs_file()
+    inputs = context.inputs
 
     if len(inputs["accounts"]) > 0 and len(inputs["ou_ids"]) > 0:
         print("Both accounts and ou_ids cannot be used together")
@@ -37,13 +40,16 @@ def main(command_line=None):
         print("Checking if necessary stack set is present in management account")
         if not any([inputs["stack_set_name"] == stack_set["StackSetName"] and "ACTIVE" == stack_set["Status"]
                     for stack_set in response["Summaries"]]):
-            subprocess.call(["python3", "orgwide_instances_create_roles.py"])
+            run_stage(context, CREATE_ROLES_STAGE)
         else:
             print("Stack set is present; creation not necessary")
     else:
         print("Automatic member role creation is OFF")
         print("Ensure that " + inputs["org_wide_role_name"] + " is present in member accounts with correct permissions")
-    subprocess.call(["python3", "orgwide_instances_data_aggregator.py"])
+    run_stage(context, AGGREGATOR_STAGE)
+
+    print("Stage times: " + ", ".join(stage + " " + str(round(seconds, 1)) + "s"
+                                      for stage, seconds in context.stage_seconds.items()))
 
 
 if __name__ == '__main__':
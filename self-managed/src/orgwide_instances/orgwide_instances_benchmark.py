@@ -0,0 +1,375 @@
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from orgwide_instances_utils import LICENSE_INCLUDED, MARKETPLACE, BYOL, categorized_fields
+from orgwide_instances_classifier import InstanceClassifier
+from orgwide_instances_records import build_record
+from orgwide_instances_fake_org import FakeOrganization, REGION_NAMES, INSTANCE_TYPES
+
+CLASSIFICATION_FILES = ["billing_codes.json", "product_codes.json", "license_included_codes.json"]
+
+PAGE_SIZE = 1000
+
+# Stages started by orgwide_instances.py when the member roles have to be created
+STARTUP_STAGES = ["orgwide_instances_create_roles", "orgwide_instances_data_aggregator"]
+# What every stage did before doing any work when it ran in its own interpreter
+STAGE_STARTUP = ("import {stage}\n"
+                 "from orgwide_instances_utils import *\n"
+                 "configure_org_cache(get_inputs())\n"
+                 "get_org_client(); get_sts_client(); get_cf_client(get_inputs()['default_region'])\n")
+# The same stages run as function calls sharing one context
+IN_PROCESS_STARTUP = ("from orgwide_instances_pipeline import PipelineContext\n"
+                      "from orgwide_instances_utils import *\n"
+                      "context = PipelineContext.from_inputs_file()\n"
+                      "for stage in {stages}:\n"
+                      "    __import__(stage)\n"
+                      "    get_org_client(); get_sts_client(); get_cf_client(context.inputs['default_region'])\n")
+
+
+def load_classification_files():
+    with open("billing_codes.json") as fp:
+        billing_codes = json.load(fp)
+    with open("product_codes.json") as fp:
+        product_codes = json.load(fp)
+    with open("license_included_codes.json") as fp:
+        license_included_map = json.load(fp)
+    return billing_codes, product_codes, license_included_map
+
+
+def generate_instances(count, billing_codes, product_codes, seed=0):
+    # A third are Marketplace instances, a tenth of them with codes missing from product_codes.json; the rest
+    # draw a usage operation uniformly from billing_codes.json
+    rnd = random.Random(seed)
+    known_codes = [code for codes in product_codes.values() for code in codes]
+    usage_operations = billing_codes[LICENSE_INCLUDED] + billing_codes[BYOL]
+    instances = []
+    for index in range(count):
+        choice = rnd.random()
+        if choice < 0.33:
+            code = rnd.choice(known_codes) if rnd.random() < 0.9 else "unknown-product-code"
+            product_codes_field = [{"ProductCodeId": code, "ProductCodeType": "marketplace"}]
+            usage_operation = "RunInstances"
+        else:
+            product_codes_field = []
+            usage_operation = rnd.choice(usage_operations)
+        instances.append({"InstanceId": "i-%017x" % index, "ProductCodes": product_codes_field,
+                          "UsageOperation": usage_operation})
+    return instances
+
+
+def legacy_classify(instances, billing_codes, product_codes, license_included_map):
+    # The per-instance linear scans the aggregator used before InstanceClassifier
+    counts = {LICENSE_INCLUDED: 0, MARKETPLACE: 0, BYOL: 0}
+    for ec2_instance in instances:
+        if len(ec2_instance["ProductCodes"]) > 0:
+            for product_code in ec2_instance["ProductCodes"]:
+                name = "UNKNOWN"
+                for product_code_name, product_code_ids in product_codes.items():
+                    if product_code["ProductCodeId"] in product_code_ids:
+                        name = product_code_name
+                        break
+            counts[MARKETPLACE] += 1
+        elif ec2_instance["UsageOperation"] in billing_codes[LICENSE_INCLUDED]:
+            license_included_map[ec2_instance["UsageOperation"]]
+            counts[LICENSE_INCLUDED] += 1
+        else:
+            counts[BYOL] += 1
+    return counts
+
+
+def indexed_classify(instances, classifier):
+    counts = {LICENSE_INCLUDED: 0, MARKETPLACE: 0, BYOL: 0}
+    for start in range(0, len(instances), PAGE_SIZE):
+        categorized = classifier.classify_page(instances[start:start + PAGE_SIZE])
+        for ec2_instance in categorized[MARKETPLACE]:
+            for product_code in ec2_instance["ProductCodes"]:
+                classifier.get_product_code_name(product_code["ProductCodeId"])
+        for ec2_instance in categorized[LICENSE_INCLUDED]:
+            classifier.get_license_included_type(ec2_instance["UsageOperation"])
+        for key, value in categorized.items():
+            counts[key] += len(value)
+    return counts
+
+
+def legacy_format_data(account_id, ec2_instance, instance_type, region, classifier):
+    # The dict based format_data the aggregator used before compact records
+    desired_fields = set(categorized_fields[instance_type]).copy()
+    for key in desired_fields.copy():
+        if ec2_instance.get(key) is None or ec2_instance.get(key) == []:
+            desired_fields.remove(key)
+    if instance_type == MARKETPLACE:
+        ec2_instance["ProductCodes"] = ":".join([classifier.get_product_code_name(product_code["ProductCodeId"])
+                                                 for product_code in ec2_instance["ProductCodes"]])
+    if instance_type == LICENSE_INCLUDED:
+        ec2_instance["LicenseIncludedType"] = classifier.get_license_included_type(ec2_instance["UsageOperation"])
+    output = {key: ec2_instance.get(key) for key in desired_fields}
+    output["AccountId"] = account_id
+    output["Region"] = region
+    return output
+
+
+def record_format_data(account_id, ec2_instance, instance_type, region, classifier):
+    values = {"AccountId": account_id, "Region": region}
+    if instance_type == MARKETPLACE:
+        values["ProductCodes"] = ":".join([classifier.get_product_code_name(product_code["ProductCodeId"])
+                                           for product_code in ec2_instance["ProductCodes"]])
+    if instance_type == LICENSE_INCLUDED:
+        values["LicenseIncludedType"] = classifier.get_license_included_type(ec2_instance["UsageOperation"])
+    return build_record(instance_type, ec2_instance, values)
+
+
+def measure_formatting(format_function, instances, classifier):
+    # Returns (seconds, peak bytes, retained bytes) for formatting every instance and keeping the rows
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = []
+    for ec2_instance in instances:
+        instance_type = classifier.classify(ec2_instance)
+        rows.append(format_function("123456789012", ec2_instance, instance_type, "us-east-1", classifier))
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, retained
+
+
+def benchmark_records(args):
+    billing_codes, product_codes, license_included_map = load_classification_files()
+    classifier = InstanceClassifier(billing_codes, product_codes, license_included_map)
+    instances = generate_instances(args.instances, billing_codes, product_codes, args.seed)
+    for ec2_instance in instances:
+        ec2_instance.update({"PlatformDetails": "Linux/UNIX", "ImageId": "ami-0123456789abcdef0",
+                             "InstanceType": "m5.large", "InstanceStateName": "running"})
+    scale = 100000 / args.instances
+
+    # The legacy path mutates its input, so each path gets its own copy
+    legacy = measure_formatting(legacy_format_data, [dict(ec2_instance) for ec2_instance in instances], classifier)
+    record = measure_formatting(record_format_data, [dict(ec2_instance) for ec2_instance in instances], classifier)
+    print("Instances: " + str(args.instances) + ", figures per 100k instances")
+    for name, (elapsed, peak, retained) in (("Dict rows", legacy), ("Records", record)):
+        print("%-10s %.3fs  peak %.1f MiB  retained %.1f MiB" % (name, elapsed * scale, peak * scale / 2 ** 20,
+                                                                 retained * scale / 2 ** 20))
+    print("Time: %.2fx, retained memory: %.2fx" % (legacy[0] / record[0], legacy[2] / record[2]))
+
+
+def benchmark_classifier(args):
+    billing_codes, product_codes, license_included_map = load_classification_files()
+    instances = generate_instances(args.instances, billing_codes, product_codes, args.seed)
+
+    start = time.perf_counter()
+    classifier = InstanceClassifier(billing_codes, product_codes, license_included_map)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    legacy_counts = legacy_classify(instances, billing_codes, product_codes, license_included_map)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed_counts = indexed_classify(instances, classifier)
+    indexed_time = time.perf_counter() - start
+
+    if legacy_counts != indexed_counts:
+        raise RuntimeError("Classifier results differ: " + str(legacy_counts) + " != " + str(indexed_counts))
+    print("Instances: " + str(args.instances) + " " + str(indexed_counts))
+    print("Index build: %.4fs" % build_time)
+    print("Linear scan: %.3fs (%.0f instances/s)" % (legacy_time, args.instances / legacy_time))
+    print("Hash index:  %.3fs (%.0f instances/s)" % (indexed_time, args.instances / indexed_time))
+    print("Speedup: %.1fx" % (legacy_time / indexed_time))
+
+
+def get_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def write_benchmark_result(output_path, result):
+    # One JSON document per line, so results of successive versions can be compared
+    with open(output_path, "a") as fp:
+        fp.write(json.dumps(result, sort_keys=True) + "\n")
+
+
+def time_interpreter(code):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True)
+    return time.perf_counter() - start
+
+
+def benchmark_startup(args):
+    # Startup cost of the orchestrator: one interpreter per stage, each importing boto3, loading service
+    # models and reading the inputs again, against all stages in one interpreter. No API call is made.
+    stages = STARTUP_STAGES[-args.stages:]
+    orchestrator = "from orgwide_instances_utils import *\nget_inputs()\n"
+    subprocess_times = []
+    in_process_times = []
+    for _ in range(args.repeat):
+        subprocess_times.append(time_interpreter(orchestrator) +
+                                sum(time_interpreter(STAGE_STARTUP.format(stage=stage)) for stage in stages))
+        in_process_times.append(time_interpreter(IN_PROCESS_STARTUP.format(stages=stages)))
+    subprocess_time = statistics.median(subprocess_times)
+    in_process_time = statistics.median(in_process_times)
+    print("Stages: " + ", ".join(stages) + " (median of " + str(args.repeat) + " runs)")
+    print("Interpreter per stage: %.3fs" % subprocess_time)
+    print("In process:            %.3fs" % in_process_time)
+    print("Saved: %.3fs (%.1fx)" % (subprocess_time - in_process_time, subprocess_time / in_process_time))
+
+
+def benchmark_aggregator(args):
+    # Runs the data aggregator end to end against FakeOrganization in a scratch directory
+    import orgwide_instances_data_aggregator as aggregator
+
+    source_dir = os.getcwd()
+    organization = FakeOrganization(args.accounts, args.regions, args.instances, seed=args.seed,
+                                    latency=args.latency_ms / 1000,
+                                    sample_path=os.path.join(source_dir, "..", "sample.json"))
+    work_dir = tempfile.mkdtemp(prefix="orgwide_instances_benchmark_")
+    for file_name in CLASSIFICATION_FILES:
+        shutil.copy(file_name, work_dir)
+    with open("orgwide_instances_inputs.json") as fp:
+        inputs = json.load(fp)
+    inputs.update({"source_regions": [], "accounts": [], "ou_ids": [], "automatic_member_role_creation": False,
+                   "check_stack_set_status": False, "max_workers": args.max_workers})
+    with open(os.path.join(work_dir, "orgwide_instances_inputs.json"), "w") as fp:
+        json.dump(inputs, fp)
+
+    aggregator.get_org_client = organization.get_org_client
+    aggregator.get_client_cache = organization.get_client_cache
+    os.chdir(work_dir)
+    try:
+        start = time.perf_counter()
+        aggregator.main([])
+        wall_time = time.perf_counter() - start
+    finally:
+        os.chdir(source_dir)
+        if not args.keep_output:
+            shutil.rmtree(work_dir)
+
+    total_instances = args.accounts * args.regions * args.instances
+    result = {
+        "benchmark": "aggregator",
+        "version": get_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "parameters": {"accounts": args.accounts, "regions": args.regions, "instances_per_region": args.instances,
+                       "latency_ms": args.latency_ms, "max_workers": args.max_workers, "seed": args.seed},
+        "wall_time_seconds": round(wall_time, 3),
+        "api_calls": sum(organization.calls.values()),
+        "api_calls_by_operation": dict(sorted(organization.calls.items())),
+        "instances": total_instances,
+        "instances_per_second": round(total_instances / wall_time, 1),
+        # ru_maxrss is reported in KiB on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    }
+    write_benchmark_result(args.output, result)
+    print("Wall time: %.2fs, API calls: %d, instances/s: %.0f, peak RSS: %.1f MiB" % (
+        wall_time, result["api_calls"], result["instances_per_second"], result["peak_rss_bytes"] / 2 ** 20))
+    if args.keep_output:
+        print("Aggregator output kept in " + work_dir)
+    print("Result appended to " + args.output)
+
+
+def benchmark_rollups(args):
+    # Fills a scratch inventory store with synthetic instances, then times the default rollups
+    import orgwide_instances_rollups as rollups
+    from orgwide_instances_records import record_types
+    from orgwide_instances_store import InventoryStore
+
+    error = rollups.check_rollups(rollups.DEFAULT_ROLLUPS)
+    if error is not None:
+        print(error)
+        return
+    source_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="orgwide_instances_benchmark_")
+    rnd = random.Random(args.seed)
+    categories = [LICENSE_INCLUDED, MARKETPLACE, BYOL]
+    platforms = ["Linux/UNIX", "Windows", "Red Hat Enterprise Linux", "SQL Server Standard"]
+    accounts = ["%012d" % (100000000000 + index) for index in range(args.accounts)]
+    try:
+        os.chdir(work_dir)
+        with InventoryStore() as store:
+            store.start_run()
+            for start in range(0, args.instances, PAGE_SIZE):
+                categorized = {category: [] for category in categories}
+                for index in range(start, min(start + PAGE_SIZE, args.instances)):
+                    category = rnd.choice(categories)
+                    values = {"AccountId": rnd.choice(accounts), "Region": rnd.choice(REGION_NAMES),
+                              "InstanceId": "i-%017x" % index, "PlatformDetails": rnd.choice(platforms),
+                              "InstanceType": rnd.choice(INSTANCE_TYPES), "InstanceStateName": "running",
+                              "VCpus": rnd.choice([2, 4, 8, 16, 32, None])}
+                    categorized[category].append(record_types[category]._make(
+                        [values.get(field) for field in categorized_fields[category]]))
+                store.write_unit(categorized, start // PAGE_SIZE)
+            store.finish_run()
+
+            start = time.perf_counter()
+            instances = rollups.load_instances(store, store.run_id, list(rollups.DIMENSIONS))
+            load_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for dimensions in rollups.DEFAULT_ROLLUPS:
+                rollups.build_rollup(instances, dimensions)
+            build_time = time.perf_counter() - start
+    finally:
+        os.chdir(source_dir)
+        shutil.rmtree(work_dir)
+
+    print("Instances: " + str(args.instances) + ", accounts: " + str(args.accounts) + ", rollups: " +
+          str(len(rollups.DEFAULT_ROLLUPS)))
+    print("Load from store: %.2fs (%.0f instances/s)" % (load_time, args.instances / load_time))
+    print("Group by:        %.2fs" % build_time)
+    print("Frame memory:    %.1f MiB" % (instances.memory_usage(deep=True).sum() / 2 ** 20))
+
+
+def main(command_line=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the org wide instance aggregator")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    classifier_parser = subparsers.add_parser("classifier", help="Product code and billing code classification")
+    classifier_parser.add_argument("--instances", type=int, default=1000000)
+    classifier_parser.add_argument("--seed", type=int, default=0)
+    classifier_parser.set_defaults(function=benchmark_classifier)
+
+    records_parser = subparsers.add_parser("records", help="Formatting instances into CSV rows, with tracemalloc")
+    records_parser.add_argument("--instances", type=int, default=100000)
+    records_parser.add_argument("--seed", type=int, default=0)
+    records_parser.set_defaults(function=benchmark_records)
+
+    aggregator_parser = subparsers.add_parser("aggregator", help="End to end aggregator run against a fake "
+                                                                 "organization")
+    aggregator_parser.add_argument("--accounts", type=int, default=50)
+    aggregator_parser.add_argument("--regions", type=int, default=17)
+    aggregator_parser.add_argument("--instances", type=int, default=200, help="Instances per account and region")
+    aggregator_parser.add_argument("--latency-ms", type=float, default=20, help="Simulated latency per API call")
+    aggregator_parser.add_argument("--max-workers", type=int, default=32)
+    aggregator_parser.add_argument("--seed", type=int, default=0)
+    aggregator_parser.add_argument("--output", default="benchmark_results.jsonl")
+    aggregator_parser.add_argument("--keep-output", action="store_true", help="Keep the aggregator's CSVs")
+    aggregator_parser.set_defaults(function=benchmark_aggregator)
+
+    startup_parser = subparsers.add_parser("startup", help="Orchestrator startup with an interpreter per stage "
+                                                           "against in-process stages")
+    startup_parser.add_argument("--stages", type=int, choices=range(1, len(STARTUP_STAGES) + 1),
+                                default=len(STARTUP_STAGES), help="Aggregator only (1) or role creation too (2)")
+    startup_parser.add_argument("--repeat", type=int, default=5)
+    startup_parser.set_defaults(function=benchmark_startup)
+
+    rollups_parser = subparsers.add_parser("rollups", help="Vectorized rollups of a stored run")
+    rollups_parser.add_argument("--instances", type=int, default=1000000)
+    rollups_parser.add_argument("--accounts", type=int, default=1000)
+    rollups_parser.add_argument("--seed", type=int, default=0)
+    rollups_parser.set_defaults(function=benchmark_rollups)
+
+    args = parser.parse_args(command_line)
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
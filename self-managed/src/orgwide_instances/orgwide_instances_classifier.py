@@ -0,0 +1,45 @@
+from orgwide_instances_utils import LICENSE_INCLUDED, MARKETPLACE, BYOL
+
+UNKNOWN_PRODUCT_CODE = "UNKNOWN"
+
+
+class InstanceClassifier:
+    # Built once per run from billing_codes.json, product_codes.json, license_included_codes.json and the
+    # custom product codes. Both lookups are hash based, so classification cost does not grow with the
+    # number of known codes.
+    def __init__(self, billing_codes, product_codes, license_included_map):
+        self.license_included_codes = frozenset(billing_codes[LICENSE_INCLUDED])
+        self.license_included_map = dict(license_included_map)
+        self.product_code_names = dict()
+        for product_code_name, product_code_ids in product_codes.items():
+            for product_code_id in product_code_ids:
+                # A code listed under several products keeps the first one, as the linear scan did
+                self.product_code_names.setdefault(product_code_id, product_code_name)
+
+    def get_product_code_name(self, product_code_id):
+        return self.product_code_names.get(product_code_id, UNKNOWN_PRODUCT_CODE)
+
+    def get_license_included_type(self, usage_operation):
+        return self.license_included_map.get(usage_operation)
+
+    def classify(self, ec2_instance):
+        if ec2_instance.get("ProductCodes"):
+            return MARKETPLACE
+        if ec2_instance.get("UsageOperation") in self.license_included_codes:
+            return LICENSE_INCLUDED
+        return BYOL
+
+    def classify_page(self, ec2_instances):
+        # Splits a page of instances by category, keeping their order inside each category
+        categorized = {LICENSE_INCLUDED: [], MARKETPLACE: [], BYOL: []}
+        license_included_codes = self.license_included_codes
+        marketplace, license_included, byol = (categorized[MARKETPLACE], categorized[LICENSE_INCLUDED],
+                                               categorized[BYOL])
+        for ec2_instance in ec2_instances:
+            if ec2_instance.get("ProductCodes"):
+                marketplace.append(ec2_instance)
+            elif ec2_instance.get("UsageOperation") in license_included_codes:
+                license_included.append(ec2_instance)
+            else:
+                byol.append(ec2_instance)
+        return categorized
@@ -0,0 +1,131 @@
+import threading
+import boto3
+from botocore.config import Config
+from botocore.credentials import CredentialProvider, CredentialResolver, RefreshableCredentials
+from botocore.session import get_session
+
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+
+
+class AssumedRoleProvider(CredentialProvider):
+    # Hands the refreshable credentials of an assumed role to a botocore session's credential chain
+    METHOD = "sts-assume-role"
+
+    def __init__(self, credentials):
+        super().__init__()
+        self.credentials = credentials
+
+    def load(self):
+        return self.credentials
+
+
+class ClientCache:
+    # Caches one refreshable assumed-role session per member account and one client per
+    # (account, region, service). Clients are thread safe and keep their HTTP connection pool, so
+    # every region crawled in an account reuses them. botocore refreshes the credentials through
+    # assume_role before Credentials.Expiration, so crawls longer than the role session keep working.
+    # Every session shares the data loader of one base session, so service models are parsed once per run
+    # rather than once per account. An account's session and clients are dropped by release_account once the
+    # account is crawled.
+    def __init__(self, role_name, session_name="AdminOrgWideInstancesAggregator",
+                 max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS, metrics=None, management_account="management"):
+        self.role_name = role_name
+        self.session_name = session_name
+        self.metrics = metrics
+        # botocore retries are disabled so throttling reaches the aggregator's adaptive rate limiter
+        self.config = Config(max_pool_connections=max_pool_connections, retries={"total_max_attempts": 1})
+        self.base_session = get_session()
+        # Resolved up front, so the sessions of accounts assumed concurrently never build their own
+        self.data_loader = self.base_session.get_component("data_loader")
+        base_session = boto3.Session(botocore_session=self.base_session)
+        # The first role assumption of each account goes through the aggregator's rate limiter; credential
+        # refreshes happen inside botocore, outside of it, so their client keeps botocore's default retries
+        self.sts_client = self.instrument(base_session.client(service_name='sts', config=self.config),
+                                          management_account, None)
+        self.refresh_sts_client = self.instrument(base_session.client(
+            service_name='sts', config=Config(max_pool_connections=max_pool_connections)), management_account, None)
+        self.lock = threading.Lock()
+        self.account_locks = dict()
+        self.sessions = dict()
+        self.clients = dict()
+        self.hits = 0
+        self.misses = 0
+        self.credential_refreshes = 0
+
+    def assume_role(self, account, sts_client=None):
+        role_arn = "arn:aws:iam::" + account + ":role/" + self.role_name
+        credentials = (sts_client or self.sts_client).assume_role(RoleArn=role_arn,
+                                                                  RoleSessionName=self.session_name)["Credentials"]
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat()
+        }
+
+    def instrument(self, client, account, region):
+        if self.metrics is not None:
+            self.metrics.register(client, account, region)
+        return client
+
+    def refresh_credentials(self, account):
+        with self.lock:
+            self.credential_refreshes += 1
+        return self.assume_role(account, self.refresh_sts_client)
+
+    def get_account_lock(self, account):
+        with self.lock:
+            return self.account_locks.setdefault(account, threading.Lock())
+
+    def get_session(self, account):
+        # Assumes the member account role on first use; raises the assume_role error if that fails
+        with self.get_account_lock(account):
+            session = self.sessions.get(account)
+            if session is None:
+                credentials = RefreshableCredentials.create_from_metadata(
+                    metadata=self.assume_role(account),
+                    refresh_using=lambda: self.refresh_credentials(account),
+                    method="sts-assume-role")
+                botocore_session = get_session()
+                botocore_session.register_component("credential_provider",
+                                                    CredentialResolver([AssumedRoleProvider(credentials)]))
+                botocore_session.register_component("data_loader", self.data_loader)
+                session = boto3.Session(botocore_session=botocore_session)
+                self.sessions[account] = session
+            return session
+
+    def get_client(self, account, region, service):
+        key = (account, region, service)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is not None:
+                self.hits += 1
+                return client
+        session = self.get_session(account)
+        with self.get_account_lock(account):
+            client = self.clients.get(key)
+            if client is None:
+                client = self.instrument(session.client(service_name=service, region_name=region,
+                                                        config=self.config), account, region)
+                with self.lock:
+                    self.clients[key] = client
+                    self.misses += 1
+            else:
+                with self.lock:
+                    self.hits += 1
+        return client
+
+    def release_account(self, account):
+        # Drops the account's session, clients with their connection pools and lock; a later get_client
+        # assumes the role again
+        with self.get_account_lock(account):
+            with self.lock:
+                self.sessions.pop(account, None)
+                for key in [key for key in self.clients if key[0] == account]:
+                    del self.clients[key]
+                self.account_locks.pop(account, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "sessions": len(self.sessions),
+                    "credential_refreshes": self.credential_refreshes}
@@ -0,0 +1,131 @@
+from orgwide_instances_utils import LICENSE_INCLUDED, MARKETPLACE, BYOL, INTEGER_FIELDS, categorized_fields
+
+# pyarrow is only needed for the Parquet and Arrow outputs and only imported by import_pyarrow, so runs that
+# write CSVs alone never load it
+pyarrow = None
+
+CSV = "csv"
+PARQUET = "parquet"
+ARROW = "arrow"
+OUTPUT_FORMATS = [CSV, PARQUET, ARROW]
+COLUMNAR_EXTENSIONS = {PARQUET: ".parquet", ARROW: ".arrow"}
+DEFAULT_ROW_GROUP_SIZE = 100000
+COMPRESSION = "zstd"
+# Columns that repeat the same few values on many rows are dictionary encoded; the others are plain strings
+DICTIONARY_FIELDS = {"AccountId", "Region", "PlatformDetails", "PlatformName", "PlatformType", "PlatformVersion",
+                     "LicenseIncludedType", "ProductCodes", "ImageId", "InstanceType", "InstanceStateName"}
+
+
+def import_pyarrow():
+    # Returns whether pyarrow is installed
+    global pyarrow
+    try:
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+def check_output_formats(output_formats):
+    # Returns an error message for unknown formats or a missing pyarrow, or None
+    unknown = [output_format for output_format in output_formats if output_format not in OUTPUT_FORMATS]
+    if unknown:
+        return "Unknown output formats " + ", ".join(unknown) + "; use " + ", ".join(OUTPUT_FORMATS)
+    if any(output_format in COLUMNAR_EXTENSIONS for output_format in output_formats) and not import_pyarrow():
+        return "pyarrow is required for Parquet and Arrow outputs; install it with: pip install pyarrow"
+    return None
+
+
+class ColumnarFile:
+    # One Parquet or Arrow IPC file written one row group (record batch) at a time. Columns are strings, as
+    # in the CSVs, unless types maps them to another pyarrow type. Dictionary encoded columns keep a
+    # dictionary that only grows, so Arrow files can append it to the file as deltas.
+    def __init__(self, path, output_format, fields, row_group_size=DEFAULT_ROW_GROUP_SIZE,
+                 dictionary_fields=DICTIONARY_FIELDS, types=None):
+        import_pyarrow()
+        self.fields = fields
+        self.row_group_size = max(1, row_group_size)
+        self.types = {field: (types or dict()).get(field, pyarrow.string()) for field in fields}
+        self.dictionaries = {field: dict() for field in fields if field in dictionary_fields}
+        self.schema = pyarrow.schema([pyarrow.field(field, pyarrow.dictionary(pyarrow.int32(), self.types[field])
+                                                    if field in self.dictionaries else self.types[field])
+                                      for field in fields])
+        self.rows = []
+        if output_format == PARQUET:
+            self.sink = None
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=COMPRESSION,
+                                                        use_dictionary=list(self.dictionaries) or False)
+        else:
+            self.sink = pyarrow.OSFile(path, "wb")
+            self.writer = pyarrow.ipc.new_file(self.sink, self.schema, options=pyarrow.ipc.IpcWriteOptions(
+                compression=COMPRESSION, emit_dictionary_deltas=True))
+
+    def get_column(self, index, field):
+        values = [row[index] for row in self.rows]
+        if self.types[field] == pyarrow.string():
+            # Written the way the CSV writer writes them, with missing values left null
+            values = [None if value is None else str(value) for value in values]
+        elif self.types[field] == pyarrow.int64():
+            # Stores created before the count columns were typed INTEGER hold them as text
+            values = [None if value is None or value == "" else int(value) for value in values]
+        if field not in self.dictionaries:
+            return pyarrow.array(values, type=self.types[field])
+        dictionary = self.dictionaries[field]
+        indices = [None if value is None else dictionary.setdefault(value, len(dictionary)) for value in values]
+        return pyarrow.DictionaryArray.from_arrays(pyarrow.array(indices, type=pyarrow.int32()),
+                                                   pyarrow.array(list(dictionary), type=self.types[field]))
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = [self.get_column(index, field) for index, field in enumerate(self.fields)]
+        self.writer.write_batch(pyarrow.record_batch(columns, schema=self.schema))
+        self.rows = []
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.rows.append(row)
+            if len(self.rows) >= self.row_group_size:
+                self.flush()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+
+class CategoryColumnarWriter:
+    # Same interface as CategoryCsvWriter, writing license_included, marketplace and byol as Parquet or Arrow
+    # IPC files with the CSV columns
+    def __init__(self, output_format, row_group_size=DEFAULT_ROW_GROUP_SIZE, categories=(LICENSE_INCLUDED, BYOL,
+                                                                                          MARKETPLACE)):
+        import_pyarrow()
+        self.files = {key: ColumnarFile(key + COLUMNAR_EXTENSIONS[output_format], output_format,
+                                        categorized_fields[key], row_group_size,
+                                        types={field: pyarrow.int64() for field in INTEGER_FIELDS})
+                      for key in categories}
+
+    def write_unit(self, categorized_ec2_instances):
+        for key, records in categorized_ec2_instances.items():
+            self.files[key].write_rows(records)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_columnar_table(path, output_format, fields, rows, integer_fields=()):
+    # Small tables such as the summary, written without dictionaries in one row group
+    import_pyarrow()
+    columnar_file = ColumnarFile(path, output_format, fields, max(1, len(rows)), dictionary_fields=(),
+                                 types={field: pyarrow.int64() for field in integer_fields})
+    columnar_file.write_rows(rows)
+    columnar_file.close()
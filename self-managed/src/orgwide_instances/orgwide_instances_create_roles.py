@@ -1,4 +1,5 @@
 from orgwide_instances_utils import *
+from orgwide_instances_pipeline import get_context
 
 
 def enable_stack_set_service():
@@ -75,11 +76,11 @@ def create_stack_set(account_id):
         exit()
 
 
-def main(command_line=None):
+def main(command_line=None, context=None):
     print("Creating roles and policies throughout member accounts")
 
     global inputs
-    inputs = get_inputs()
+    inputs = get_context(context).inputs
 
     manager_account_id = get_current_account_id()
 
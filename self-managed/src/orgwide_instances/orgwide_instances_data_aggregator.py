@@ -1,74 +1,171 @@
+import argparse
 import csv
+import math
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from orgwide_instances_utils import *
+from orgwide_instances_executor import FanOutExecutor, OrderedResults, DEFAULT_MAX_WORKERS, \
+    DEFAULT_MAX_WORKERS_PER_ACCOUNT, DEFAULT_MAX_CHUNK_WORKERS
+from orgwide_instances_client_cache import ClientCache
+from orgwide_instances_classifier import InstanceClassifier
+from orgwide_instances_store import InventoryStore, DEFAULT_STORE_PATH
+from orgwide_instances_writers import CategoryCsvWriter
+from orgwide_instances_diff import write_run_diff, ADDED, REMOVED, RECATEGORIZED
+from orgwide_instances_rollups import check_rollups, write_rollups
+from orgwide_instances_instance_types import InstanceTypeCatalog, DEFAULT_CATALOG_PATH, DEFAULT_CATALOG_TTL
+from orgwide_instances_sampling import OU_STRATA, SIZE_STRATA, DEFAULT_SAMPLE_SEED, parse_fraction, get_ou_strata, \
+    get_size_strata, merge_small_strata, get_budget_sample_size, select_sample, estimate_totals, \
+    write_summary_estimate
+from orgwide_instances_records import build_record
+from orgwide_instances_throttling import RateLimiter, DEFAULT_REQUESTS_PER_SECOND, DEFAULT_MAX_ATTEMPTS, \
+    get_error_code
+from orgwide_instances_metrics import get_operation_name
+from orgwide_instances_org_tree import OrgTreeWalker, DEFAULT_ORG_TREE_WORKERS, DEFAULT_ORG_TREE_PATH, \
+    DEFAULT_ORG_TREE_TTL, get_account_summary, get_tree_accounts, filter_suspended_accounts, load_tree_snapshot, \
+    write_tree_snapshot, unique
+from orgwide_instances_pipeline import get_context
+from orgwide_instances_shards import parse_shard, select_shard_accounts, write_shard_manifest
+from orgwide_instances_journal import CheckpointJournal, DEFAULT_JOURNAL_PATH
+from orgwide_instances_scheduler import UnitHistory, DEFAULT_HISTORY_PATH, plan_tasks, get_ideal_seconds
+from orgwide_instances_region_planner import RegionPlanner, DEFAULT_REGION_PLAN_PATH, DEFAULT_REGION_CACHE_TTL
+from orgwide_instances_columnar import CategoryColumnarWriter, CSV, COLUMNAR_EXTENSIONS, DEFAULT_ROW_GROUP_SIZE, \
+    check_output_formats, write_columnar_table
 
 summary = dict()
 error_messages = dict()
 misconfigured_accounts = set()
+results_lock = threading.Lock()
+
+DESCRIBE_INSTANCES_PAGE_SIZE = 1000
+# Smallest page DescribeInstances accepts, used to probe regions that were empty in the previous run
+EMPTY_REGION_PROBE_SIZE = 5
+# DescribeInstanceInformation accepts at most 50 results per page; chunks of the same size are
+# answered in a single page
+SSM_INSTANCE_IDS_PER_REQUEST = 50
+# DescribeInstances fields kept after decoding a page; everything else is dropped right away
+projected_fields = sorted(set().union(*categorized_fields.values()) - {"AccountId", "Region", "VCpus", "CoreCount",
+                                                                       "Sockets"} |
+                          {"UsageOperation", "ProductCodes", "CpuOptions"})
+executor = FanOutExecutor()
+client_cache = None
+rate_limiter = RateLimiter()
+journal = None
+history = UnitHistory(None)
+region_planner = RegionPlanner(None)
+instance_types = InstanceTypeCatalog(None)
+
+
+def call_api(account, region, service, function, /, *, operation=None, **kwargs):
+    # Every API call of the aggregator goes through here: bounded per service by the executor, paced by the
+    # (account, service, region) token bucket and retried on throttling. Retries are counted under operation,
+    # by default named after the client method.
+    operation = operation or get_operation_name(function)
+    with executor.service_slot(service):
+        return rate_limiter.call((account, service, region), operation, function, **kwargs)
 
 
 def check_stack_set_status():
-    cf_client = get_cf_client(inputs['default_region'])
+    # Detects drift on the stack set and returns the drift status of each account's stack instance in the
+    # default region, read in one paginated ListStackInstances pass
+    region = inputs['default_region']
+    cf_client = get_cf_client(region, rate_limited=True)
     caller = check_if_delegated_admin()
-    response = cf_client.detect_stack_set_drift(StackSetName=inputs["stack_set_name"],
-                                                CallAs=caller)
-    operation_id = response["OperationId"]
-    response = cf_client.describe_stack_set_operation(StackSetName=inputs["stack_set_name"],
-                                                      OperationId=operation_id,
-                                                      CallAs=caller)
-    while response["StackSetOperation"]["Status"] == "RUNNING" or response["StackSetOperation"]["Status"] == "QUEUED":
-        print("Polling to see if necessary roles and permissions are present in member accounts")
-        time.sleep(10)
-        response = cf_client.describe_stack_set_operation(StackSetName=inputs["stack_set_name"],
-                                                          OperationId=operation_id,
-                                                          CallAs=caller)
+    response = call_api(MANAGEMENT_ACCOUNT, region, "cloudformation", cf_client.detect_stack_set_drift,
+                        StackSetName=inputs["stack_set_name"],
+                        CallAs=caller)
+    print("Polling to see if necessary roles and permissions are present in member accounts")
+    for _ in wait_for_stack_set_operations(
+            caller, cf_client, [response["OperationId"]], inputs["stack_set_name"],
+            describe_operation=lambda **kwargs: call_api(MANAGEMENT_ACCOUNT, region, "cloudformation",
+                                                         cf_client.describe_stack_set_operation, **kwargs)):
+        pass
+    drift_status = dict()
+    request = {"StackSetName": inputs["stack_set_name"], "StackInstanceRegion": region, "CallAs": caller,
+               "MaxResults": 100}
+    while True:
+        response = call_api(MANAGEMENT_ACCOUNT, region, "cloudformation", cf_client.list_stack_instances, **request)
+        for stack_instance in response["Summaries"]:
+            drift_status[stack_instance["Account"]] = stack_instance.get("DriftStatus", "UNKNOWN")
+        if "NextToken" not in response:
+            return drift_status
+        request["NextToken"] = response["NextToken"]
+
+
+def merge_stack_set_status(all_accounts, drift_status):
+    # Accounts without a stack instance are counted as potentially misconfigured, drifted ones are also
+    # reported as STS errors
     misconfigured_stacks = 0
-    for account in list_all_accounts():
-        try:
-            dsi_response = cf_client.describe_stack_instance(
-                StackSetName=inputs["stack_set_name"],
-                StackInstanceAccount=account,
-                StackInstanceRegion=inputs["default_region"],
-                CallAs= caller
-            )
-            if dsi_response["StackInstance"]["DriftStatus"] != "IN_SYNC":
-                misconfigured_stacks += 1
-                summary[account][STS_ERRORS] += 1
-                error_messages[account][STS_ERROR_MESSAGES].append("Potentially incorrect stack instance for "
-                                                                   "roles and permissions")
-        except Exception as Argument:
+    for account in all_accounts:
+        if account not in drift_status:
             misconfigured_stacks += 1
+        elif drift_status[account] != "IN_SYNC":
+            misconfigured_stacks += 1
+            result = initialize_unit_result(account)
+            record_error(result, STS_ERRORS, STS_ERROR_MESSAGES, "Potentially incorrect stack instance for "
+                                                                 "roles and permissions")
+            merge_unit_result(result)
 
     if misconfigured_stacks > 0:
         print("WARNING - Number of potentially misconfigured accounts: " + str(misconfigured_stacks))
 
 
-def list_all_accounts():
-    org_client = get_org_client()
-    if len(inputs['accounts']) == 0 and len(inputs['ou_ids']) == 0:
-        response = org_client.list_accounts()
-        all_accounts = []
+def list_organization_accounts(org_client):
+    response = call_api(MANAGEMENT_ACCOUNT, None, "organizations", org_client.list_accounts)
+    all_accounts = []
+
+    for account in response["Accounts"]:
+        all_accounts.append(get_account_summary(account))
 
+    while "NextToken" in response:
+        response = call_api(MANAGEMENT_ACCOUNT, None, "organizations", org_client.list_accounts,
+                            NextToken=response["NextToken"])
         for account in response["Accounts"]:
-            all_accounts.append(account["Id"])
+            all_accounts.append(get_account_summary(account))
 
-        while "NextToken" in response:
-            response = org_client.list_accounts(NextToken=response["NextToken"])
-            for account in response["Accounts"]:
-                all_accounts.append(account["Id"])
+    return all_accounts
 
-        return all_accounts
-    all_accounts = inputs['accounts']
-    for ou_id in inputs['ou_ids']:
-        response = org_client.list_accounts_for_parent(ParentId=ou_id)
-        for account in response["Accounts"]:
-            all_accounts.append(account["Id"])
 
-        while "NextToken" in response:
-            response = org_client.list_accounts_for_parent(ParentId=ou_id, NextToken=response["NextToken"])
-            for account in response["Accounts"]:
-                all_accounts.append(account["Id"])
+def walk_organizational_units(org_client, ou_ids):
+    walker = OrgTreeWalker(org_client,
+                           lambda function, **kwargs: call_api(MANAGEMENT_ACCOUNT, None, "organizations", function,
+                                                               **kwargs),
+                           max_workers=(inputs.get("max_workers_per_service") or {}).get("organizations",
+                                                                                         DEFAULT_ORG_TREE_WORKERS))
+    return walker.walk(ou_ids)
 
-    return list(set(all_accounts))
+
+def get_org_tree(org_client):
+    # The OU tree below "ou_ids" comes from the organization metadata cache, else from the snapshot an
+    # earlier run wrote while it is younger than "org_tree_ttl"; only otherwise is it walked and snapshotted
+    def load():
+        tree = load_tree_snapshot(DEFAULT_ORG_TREE_PATH, inputs['ou_ids'],
+                                  inputs.get("org_tree_ttl", DEFAULT_ORG_TREE_TTL))
+        if tree is None:
+            tree = walk_organizational_units(org_client, inputs['ou_ids'])
+            write_tree_snapshot(tree, DEFAULT_ORG_TREE_PATH)
+        return tree
+    return org_cache.get("org_tree:" + ",".join(inputs['ou_ids']), load)
+
+
+def list_all_accounts():
+    # Account listings and the OU tree come from the organization metadata cache when it holds them. The
+    # order is stable: the given accounts first, then the accounts of the OUs and their descendants.
+    org_client = get_org_client(rate_limited=True)
+    if len(inputs['accounts']) == 0 and len(inputs['ou_ids']) == 0:
+        accounts = org_cache.get("organization_accounts", lambda: list_organization_accounts(org_client))
+    else:
+        accounts = [{"Id": account_id, "Status": ""} for account_id in inputs['accounts']]
+        if len(inputs['ou_ids']) > 0:
+            accounts += get_tree_accounts(get_org_tree(org_client))
+
+    if inputs.get("exclude_suspended_accounts", False):
+        active_accounts = filter_suspended_accounts(accounts)
+        if len(active_accounts) < len(accounts):
+            print("Skipping " + str(len(accounts) - len(active_accounts)) + " suspended accounts")
+        accounts = active_accounts
+    return unique(account["Id"] for account in accounts)
 
 
 def get_license_included_map():
@@ -90,173 +187,352 @@ def get_product_codes():
         return [item for sublist in product_codes.values() for item in sublist], product_codes
 
 
-def sts_assume_role(account):
-    sts_client = get_sts_client()
-    role_arn = "arn:aws:iam::" + account + ":role/" + inputs["org_wide_role_name"]
+def sts_assume_role(result):
     try:
-        sts_response = sts_client.assume_role(
-            RoleArn=role_arn,
-            RoleSessionName="AdminOrgWideInstancesAggregator",
-        )
+        call_api(MANAGEMENT_ACCOUNT, None, "sts", client_cache.get_session, operation="AssumeRole",
+                 account=result["account"])
     except Exception as Argument:
-        summary[account][STS_ERRORS] += 1
-        error_messages[account][STS_ERROR_MESSAGES].append(str(Argument))
-        return None
-    return sts_response
+        record_error(result, STS_ERRORS, STS_ERROR_MESSAGES, str(Argument))
+        return False
+    return True
 
 
-def get_regions(account, sts_response):
+def describe_regions(account):
+    ec2_client = client_cache.get_client(account, inputs["default_region"], "ec2")
+    response = call_api(account, inputs["default_region"], "ec2", ec2_client.describe_regions)
+    return [region["RegionName"] for region in response["Regions"]]
+
+
+def get_regions(result):
+    # Region lists come from the region planner's cache while they are fresh
     try:
-        ec2_client = get_ec2_client(sts_response["Credentials"]["AccessKeyId"],
-                                    sts_response["Credentials"]["SecretAccessKey"],
-                                    sts_response["Credentials"]["SessionToken"],
-                                    inputs["default_region"])
-        response = ec2_client.describe_regions()
+        return region_planner.get_regions(result["account"], lambda: describe_regions(result["account"]))
     except Exception as Argument:
-        summary[account]["ec2_errors"] += 1
-        error_messages[account]["ec2_error_messages"].append(inputs["default_region"] + ": " + str(Argument))
-        if Argument.response['Error']['Code'] == 'UnauthorizedOperation':
-            misconfigured_accounts.add(account)
+        record_error(result, EC2_ERRORS, EC2_ERROR_MESSAGES, inputs["default_region"] + ": " + str(Argument),
+                     misconfigured=get_error_code(Argument) == 'UnauthorizedOperation')
         return []
-    return [region["RegionName"] for region in response["Regions"]]
 
 
-def format_data_helper(product_code_id, product_codes):
-    for product_code_name, product_code_ids in product_codes.items():
-        if product_code_id in product_code_ids:
-            return product_code_name
-    return "UNKNOWN"
+def get_classifier():
+    all_product_codes, product_codes = get_product_codes()
+    return InstanceClassifier(get_billing_codes(), product_codes, get_license_included_map())
+
+
+def describe_instance_types(region, **request):
+    # The catalog is described with the management/delegated admin credentials, in the instance's region
+    ec2_client = get_management_client("ec2", region, rate_limited=True)
+    return call_api(MANAGEMENT_ACCOUNT, region, "ec2", ec2_client.describe_instance_types, **request)
 
 
-def format_data(account_id, ec2_instance, instance_type, region, product_codes=None, license_included_map=None):
-    desired_fields = categorized_fields[instance_type].copy()
-    for key in desired_fields.copy():
-        if ec2_instance.get(key) is None or ec2_instance.get(key) == []:
-            desired_fields.remove(key)
+def get_cpu_counts(ec2_instance, region):
+    # (vCPUs, cores) from the CpuOptions the instance was launched with, otherwise the instance type's defaults
+    cpu_options = ec2_instance.get("CpuOptions")
+    if cpu_options and "CoreCount" in cpu_options:
+        cores = cpu_options["CoreCount"]
+        return cores * cpu_options.get("ThreadsPerCore", 1), cores
+    entry = instance_types.get(ec2_instance.get("InstanceType"),
+                               lambda **request: describe_instance_types(region, **request))
+    if entry is None:
+        return None, None
+    return entry["vcpus"], entry["cores"]
+
+
+def format_data(account_id, ec2_instance, instance_type, region, classifier=None, instance_information=None):
+    values = {"AccountId": account_id, "Region": region}
+    values["VCpus"], values["CoreCount"] = get_cpu_counts(ec2_instance, region)
+    # EC2 does not report sockets; they are only known for the types listed in "instance_type_sockets"
+    values["Sockets"] = inputs.get("instance_type_sockets", {}).get(ec2_instance.get("InstanceType"))
     if instance_type == MARKETPLACE:
-        ec2_instance["ProductCodes"] = ":".join([format_data_helper(product_code["ProductCodeId"], product_codes)
-                                                 for product_code in ec2_instance["ProductCodes"]])
+        values["ProductCodes"] = ":".join([classifier.get_product_code_name(product_code["ProductCodeId"])
+                                           for product_code in ec2_instance["ProductCodes"]])
     if instance_type == LICENSE_INCLUDED:
-        ec2_instance["LicenseIncludedType"] = license_included_map[ec2_instance["UsageOperation"]]
-    output = {key: ec2_instance.get(key) for key in desired_fields}
-    output["AccountId"] = account_id
-    output["Region"] = region
-    return output
-
+        values["LicenseIncludedType"] = classifier.get_license_included_type(ec2_instance["UsageOperation"])
+    if instance_information:
+        values.update(instance_information)
+    return build_record(instance_type, ec2_instance, values)
 
-def fetch_ec2_instances(account, region, sts_response):
-    try:
-        ec2_client = get_ec2_client(sts_response["Credentials"]["AccessKeyId"],
-                                    sts_response["Credentials"]["SecretAccessKey"],
-                                    sts_response["Credentials"]["SessionToken"],
-                                    region)
 
-        response = ec2_client.describe_instances()
+def project_instance(ec2_instance):
+    projected = {key: ec2_instance[key] for key in projected_fields if key in ec2_instance}
+    projected["InstanceStateName"] = ec2_instance.get("State", {}).get("Name")
+    return projected
 
-        ec2_instances = []
-        for reservation in response["Reservations"]:
-            ec2_instances += reservation["Instances"]
 
-        while "NextToken" in response:
-            response = ec2_client.describe_instances(NextToken=response["NextToken"])
-            for reservation in response["Reservations"]:
-                ec2_instances += reservation["Instances"]
+def fetch_ec2_instances(result, region, probe=False):
+    # Yields one page of projected instances at a time. On error the pages already yielded are kept. With
+    # probe, a region is first asked for a single small page, which is all there is to read when the region
+    # is still empty or holds only a few instances.
+    try:
+        ec2_client = client_cache.get_client(result["account"], region, "ec2")
+        if probe:
+            region_planner.count("probed_regions")
+            response = call_api(result["account"], region, "ec2", ec2_client.describe_instances,
+                                MaxResults=EMPTY_REGION_PROBE_SIZE)
+            if "NextToken" not in response:
+                region_planner.count("scans_avoided")
+                yield [project_instance(ec2_instance) for reservation in response["Reservations"]
+                       for ec2_instance in reservation["Instances"]]
+                return
+        request = {"MaxResults": DESCRIBE_INSTANCES_PAGE_SIZE}
+        while True:
+            response = call_api(result["account"], region, "ec2", ec2_client.describe_instances, **request)
+            yield [project_instance(ec2_instance) for reservation in response["Reservations"]
+                   for ec2_instance in reservation["Instances"]]
+            if "NextToken" not in response:
+                return
+            request["NextToken"] = response["NextToken"]
 
     except Exception as Argument:
-        summary[account][EC2_ERRORS] += 1
-        error_messages[account][EC2_ERROR_MESSAGES].append(region + ": " + str(Argument))
-        if Argument.response['Error']['Code'] == 'UnauthorizedOperation':
-            misconfigured_accounts.add(account)
-        return []
-    return ec2_instances
+        record_error(result, EC2_ERRORS, EC2_ERROR_MESSAGES, region + ": " + str(Argument),
+                     misconfigured=get_error_code(Argument) == 'UnauthorizedOperation')
 
 
 def initialize_summary():
     return {TOTAL: 0, LICENSE_INCLUDED: 0, MARKETPLACE: 0, BYOL: 0, TOTAL_ERRORS: 0, STS_ERRORS: 0, EC2_ERRORS: 0,
-            SSM_ERRORS: 0}
+            SSM_ERRORS: 0, BYOL_CORES: 0}
 
 
 def initialize_error_message():
     return {STS_ERROR_MESSAGES: [], EC2_ERROR_MESSAGES: [], SSM_ERROR_MESSAGES: []}
 
 
-def categorize_ec2_instances(all_accounts):
-    categorized_ec2 = {LICENSE_INCLUDED: [], BYOL: [], MARKETPLACE: []}
-    license_included_map = get_license_included_map()
-    all_billing_codes = get_billing_codes()
-    all_product_codes, product_codes = get_product_codes()
-    for account in all_accounts:
-        sts_response = sts_assume_role(account)
-        if sts_response is None:
-            continue
-
-        if inputs["source_regions"]:
-            source_regions = inputs["source_regions"]
-        else:
-            source_regions = get_regions(account, sts_response)
-        for region in source_regions:
-            byol = []
-            ec2_instances = fetch_ec2_instances(account, region, sts_response)
-            for ec2_instance in ec2_instances:
-                if len(ec2_instance["ProductCodes"]) > 0:
-                    categorized_ec2[MARKETPLACE].append(format_data(account, ec2_instance, MARKETPLACE, region,
-                                                                    product_codes=product_codes))
-                    summary[account][MARKETPLACE] += 1
-                elif ec2_instance["UsageOperation"] in all_billing_codes[LICENSE_INCLUDED]:
-                    categorized_ec2[LICENSE_INCLUDED].append(format_data(account, ec2_instance, LICENSE_INCLUDED, region,
-                                                                         license_included_map=license_included_map))
-                    summary[account][LICENSE_INCLUDED] += 1
-                else:
-                    byol.append(ec2_instance)
-                    summary[account][BYOL] += 1
-            if byol:
-                categorized_ec2[BYOL] += get_ec2_instance_information(
-                    account, byol, region, sts_response)
-    return categorized_ec2
-
-
-def get_ec2_instance_information(account, ec2_instances, region, sts_response):
-    try:
-        ssm_client = get_ssm_client(sts_response["Credentials"]["AccessKeyId"],
-                                    sts_response["Credentials"]["SecretAccessKey"],
-                                    sts_response["Credentials"]["SessionToken"],
-                                    region)
-        ec2_instance_mapping = {ec2_instance["InstanceId"]: ec2_instance for ec2_instance in ec2_instances}
-        ec2_instance_information_list = []
-        response = ssm_client.describe_instance_information(Filters=[{
-            "Key": "InstanceIds",
-            "Values": [ec2_instance["InstanceId"] for ec2_instance in ec2_instances]
-        }])
-        ec2_instance_information_list += response["InstanceInformationList"]
-        while "NextToken" in response:
-            response = ssm_client.describe_instance_information(NextToken=response["NextToken"])
-            ec2_instance_information_list += response["InstanceInformationList"]
-    except Exception as Argument:
-        summary[account][SSM_ERRORS] += 1
-        error_messages[account][SSM_ERROR_MESSAGES].append(region + ": " + str(Argument))
-        if Argument.response['Error']['Code'] == 'NotAuthorized':
-            misconfigured_accounts.add(account)
-        return []
+def initialize_unit_result(account, region=None):
+    return {"account": account, "region": region, "summary": initialize_summary(),
+            "error_messages": initialize_error_message(), "misconfigured": False,
+            "categorized_ec2": {LICENSE_INCLUDED: [], BYOL: [], MARKETPLACE: []}}
 
-    # Filter SSM Describe Instance Information
-    instance_information_keys = ["PlatformName", "PlatformType", "PlatformVersion"]
-    for ec2_instance_information in ec2_instance_information_list:
-        for key in instance_information_keys:
-            ec2_instance_mapping[ec2_instance_information["InstanceId"]][key] = ec2_instance_information[key]
-    return [format_data(account, ec2_instance, BYOL, region) for ec2_instance in ec2_instance_mapping.values()]
 
+def record_error(result, error_type, error_message_type, message, misconfigured=False):
+    result["summary"][error_type] += 1
+    result["error_messages"][error_message_type].append(message)
+    if misconfigured:
+        result["misconfigured"] = True
 
-def output_csv_helper(ec2_instance, key):
-    return [ec2_instance.get(field) for field in categorized_fields[key]]
 
+def merge_unit_result(result):
+    account = result["account"]
+    with results_lock:
+        for key, value in result["summary"].items():
+            summary[account][key] += value
+        for key, messages in result["error_messages"].items():
+            error_messages[account][key] += messages
+        if result["misconfigured"]:
+            misconfigured_accounts.add(account)
 
-def output_csv(categorized_ec2_instances):
-    for key, value in categorized_ec2_instances.items():
-        with open(key + ".csv", 'w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(categorized_fields[key])
-            for ec2_instance in value:
-                writer.writerow(output_csv_helper(ec2_instance, key))
+
+def get_rate_limiter():
+    return RateLimiter(requests_per_second=inputs.get("requests_per_second", DEFAULT_REQUESTS_PER_SECOND),
+                       max_attempts=inputs.get("max_attempts", DEFAULT_MAX_ATTEMPTS),
+                       retry_listener=api_metrics.record_retry)
+
+
+def write_throttling_report():
+    rows = rate_limiter.get_report()
+    with open("throttling.csv", 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=["AccountId", "Service", "Region", "Requests", "ThrottleEvents",
+                                                  "Retries", "ThrottledSeconds", "WaitedSeconds",
+                                                  "FinalRequestsPerSecond"])
+        writer.writeheader()
+        writer.writerows(rows)
+    throttled = [row for row in rows if row["ThrottleEvents"] > 0]
+    if throttled:
+        print("Throttled in " + str(len(throttled)) + " of " + str(len(rows)) + " buckets for a total of " +
+              str(round(sum(row["ThrottledSeconds"] for row in throttled), 1)) + " seconds; see throttling.csv")
+
+
+def get_executor():
+    return FanOutExecutor(max_workers=inputs.get("max_workers", DEFAULT_MAX_WORKERS),
+                          max_workers_per_account=inputs.get("max_workers_per_account",
+                                                             DEFAULT_MAX_WORKERS_PER_ACCOUNT),
+                          max_workers_per_service=inputs.get("max_workers_per_service"),
+                          max_chunk_workers=inputs.get("max_chunk_workers", DEFAULT_MAX_CHUNK_WORKERS))
+
+
+def get_client_cache():
+    return ClientCache(inputs["org_wide_role_name"],
+                       max_pool_connections=inputs.get("max_workers", DEFAULT_MAX_WORKERS),
+                       metrics=api_metrics, management_account=MANAGEMENT_ACCOUNT)
+
+
+def prepare_account(account):
+    result = initialize_unit_result(account)
+    if not sts_assume_role(result):
+        return result, []
+
+    if inputs["source_regions"]:
+        source_regions = inputs["source_regions"]
+    else:
+        source_regions = get_regions(result)
+    return result, source_regions
+
+
+def categorize_region(account, region, classifier, probe=False):
+    result = initialize_unit_result(account, region)
+    categorized_ec2 = result["categorized_ec2"]
+    byol = []
+    # The next page is requested while the current one is classified
+    for page in executor.prefetch(fetch_ec2_instances(result, region, probe)):
+        classified = classifier.classify_page(page)
+        for key in (MARKETPLACE, LICENSE_INCLUDED):
+            categorized_ec2[key] += [format_data(account, ec2_instance, key, region, classifier=classifier)
+                                     for ec2_instance in classified[key]]
+            result["summary"][key] += len(classified[key])
+        byol += classified[BYOL]
+    result["summary"][BYOL] += len(byol)
+    if byol:
+        categorized_ec2[BYOL] += get_ec2_instance_information(result, byol, region)
+        result["summary"][BYOL_CORES] += sum(record.CoreCount or 0 for record in categorized_ec2[BYOL])
+    return result
+
+
+def has_errors(result):
+    return result["misconfigured"] or any(result["summary"][key] for key in (STS_ERRORS, EC2_ERRORS, SSM_ERRORS))
+
+
+def resume_or_prepare_account(account):
+    prepared = journal.get_account(account)
+    if prepared is not None:
+        return prepared
+    return prepare_account(account)
+
+
+def resume_or_categorize_region(account, region, classifier):
+    result = journal.get_unit(account, region)
+    if result is not None:
+        return result
+    start = time.perf_counter()
+    result = categorize_region(account, region, classifier,
+                               probe=inputs.get("probe_empty_regions", True) and history.is_empty(account, region))
+    if not has_errors(result):
+        history.record(account, region, time.perf_counter() - start,
+                       sum(result["summary"][key] for key in (LICENSE_INCLUDED, MARKETPLACE, BYOL)))
+    return result
+
+
+def crawl_task(account, regions, classifier):
+    # One or more regions of an account, crawled one after the other
+    return [(index, resume_or_categorize_region(account, region, classifier)) for index, region in regions]
+
+
+def categorize_ec2_instances(all_accounts, store, writers, context):
+    global executor, client_cache, history, region_planner, instance_types
+    executor = get_executor()
+    history = UnitHistory(DEFAULT_HISTORY_PATH)
+    region_planner = RegionPlanner(DEFAULT_REGION_PLAN_PATH,
+                                   inputs.get("region_cache_ttl", DEFAULT_REGION_CACHE_TTL))
+    instance_types = InstanceTypeCatalog(DEFAULT_CATALOG_PATH,
+                                         inputs.get("instance_type_catalog_ttl", DEFAULT_CATALOG_TTL))
+    # Member account sessions assumed by an earlier stage of the same run are reused
+    if context.client_cache is None:
+        context.client_cache = get_client_cache()
+    client_cache = context.client_cache
+    classifier = get_classifier()
+    try:
+        crawl_units(all_accounts, classifier, store, writers)
+    finally:
+        executor.close()
+        history.save()
+        region_planner.save()
+        instance_types.save()
+
+    stats = client_cache.get_stats()
+    print("Client cache: " + str(stats["hits"]) + " hits, " + str(stats["misses"]) + " misses, " +
+          str(stats["credential_refreshes"]) + " credential refreshes")
+    stats = region_planner.get_stats()
+    print("Region planner: " + str(stats["cached_region_lists"]) + " region lists from cache, " +
+          str(stats["described_region_lists"]) + " described, " + str(stats["opt_in_classes"]) +
+          " opt-in classes; " + str(stats["scans_avoided"]) + " of " + str(stats["probed_regions"]) +
+          " probed regions needed no full scan")
+    stats = instance_types.get_stats()
+    if stats["catalog_lookups"] or stats["unknown_types"]:
+        print("Instance type catalog: " + str(stats["catalog_lookups"]) + " instances sized from " +
+              str(stats["instance_types"]) + " types, " + str(stats["described_types"]) + " types described " +
+              "one by one, " + str(stats["unknown_types"]) + " instances of unknown types")
+
+
+def crawl_units(all_accounts, classifier, store, writers):
+    # Account setup (role assumption and region discovery) fans out first, then every (account, region)
+    # unit is crawled concurrently. Each unit's rows are written to the store as soon as the unit finishes,
+    # under its unit index, so no rows are held in memory while slower units run. Units are then released in
+    # unit order: their summaries and error messages are merged and their rows, read back from the store,
+    # are appended to the CSV and columnar writers, so the output is deterministic. Units without errors
+    # are journaled as they finish; the ones a resumed run finds in the journal are replayed from it.
+    # An account's session and clients are released as soon as its last unit finishes.
+    units = []
+    ordered_accounts = OrderedResults()
+    for index, prepared in executor.run(resume_or_prepare_account, [(account,) for account in all_accounts]):
+        if not has_errors(prepared[0]):
+            journal.record_account(*prepared)
+        for result, source_regions in ordered_accounts.add(index, prepared):
+            merge_unit_result(result)
+            units += [(result["account"], region, classifier) for region in source_regions]
+            if not source_regions:
+                client_cache.release_account(result["account"])
+    remaining_units = Counter(account for account, _, _ in units)
+
+    # Units are started longest first according to the previous runs, while the output keeps unit order
+    tasks, ranks, estimates = plan_tasks(units, history if inputs.get("schedule_by_history", True)
+                                         else UnitHistory(None))
+    start = time.perf_counter()
+    ordered_units = OrderedResults()
+    for _, task_results in executor.run(crawl_task, tasks, ranks):
+        for index, unit_result in task_results:
+            if not has_errors(unit_result):
+                journal.record_unit(unit_result)
+            categories = store.write_unit(unit_result.pop("categorized_ec2"), index)
+            remaining_units[unit_result["account"]] -= 1
+            if remaining_units[unit_result["account"]] == 0:
+                client_cache.release_account(unit_result["account"])
+            for released_index, released_categories, result in ordered_units.add(index, (index, categories,
+                                                                                         unit_result)):
+                merge_unit_result(result)
+                if writers and released_categories:
+                    categorized_ec2 = store.get_unit(released_index, released_categories)
+                    for writer in writers:
+                        writer.write_unit(categorized_ec2)
+
+    ideal_seconds = get_ideal_seconds(estimates, executor.max_workers)
+    if ideal_seconds is not None:
+        print("Crawled " + str(len(units)) + " regions in " + str(len(tasks)) + " tasks in " +
+              str(round(time.perf_counter() - start, 1)) + "s; " + str(round(ideal_seconds, 1)) +
+              "s expected from previous runs")
+
+
+def fetch_instance_information(account, region, ssm_client, instance_ids):
+    # Every page keeps the InstanceIds filter, so only the requested instances are returned
+    instance_information_keys = ["PlatformName", "PlatformType", "PlatformVersion"]
+    request = {"Filters": [{"Key": "InstanceIds", "Values": instance_ids}],
+               "MaxResults": SSM_INSTANCE_IDS_PER_REQUEST}
+    instance_information = dict()
+    while True:
+        response = call_api(account, region, "ssm", ssm_client.describe_instance_information, **request)
+        for ec2_instance_information in response["InstanceInformationList"]:
+            instance_information[ec2_instance_information["InstanceId"]] = {
+                key: ec2_instance_information.get(key) for key in instance_information_keys}
+        if "NextToken" not in response:
+            return instance_information
+        request["NextToken"] = response["NextToken"]
+
+
+def get_ec2_instance_information(result, ec2_instances, region):
+    # BYOL instances are enriched with their SSM platform in API sized chunks issued concurrently. If SSM
+    # fails, the instances are still written without platform details and the error is reported.
+    account = result["account"]
+    instance_information = dict()
+    try:
+        ssm_client = client_cache.get_client(account, region, "ssm")
+        instance_ids = [ec2_instance["InstanceId"] for ec2_instance in ec2_instances]
+        for chunk_information in executor.map_chunks(
+                lambda chunk: fetch_instance_information(account, region, ssm_client, chunk),
+                instance_ids, SSM_INSTANCE_IDS_PER_REQUEST):
+            instance_information.update(chunk_information)
+    except Exception as Argument:
+        record_error(result, SSM_ERRORS, SSM_ERROR_MESSAGES, region + ": " + str(Argument),
+                     misconfigured=get_error_code(Argument) == 'NotAuthorized')
+
+    return [format_data(account, ec2_instance, BYOL, region,
+                        instance_information=instance_information.get(ec2_instance["InstanceId"]))
+            for ec2_instance in ec2_instances]
 
 
 def get_iam_client(access_key, secret_key, session_token):
@@ -266,44 +542,35 @@ def get_iam_client(access_key, secret_key, session_token):
                         aws_session_token=session_token)
 
 
-def get_ec2_client(access_key, secret_key, session_token, region=None):
-    return boto3.client(service_name='ec2',
-                        aws_access_key_id=access_key,
-                        aws_secret_access_key=secret_key,
-                        aws_session_token=session_token,
-                        region_name=region)
-
-
-def get_ssm_client(access_key, secret_key, session_token, region):
-    return boto3.client(service_name='ssm',
-                        aws_access_key_id=access_key,
-                        aws_secret_access_key=secret_key,
-                        aws_session_token=session_token,
-                        region_name=region)
-
-
-def create_summary(all_accounts):
-    with open("summary.csv", 'w', newline='') as file:
-        writer = csv.writer(file)
-        summary['ALL'] = initialize_summary()
-        for key in summary['ALL'].keys():
-            summary['ALL'][key] = sum([summary[account][key] for account in all_accounts])
-        keys = ['ALL'] + all_accounts
-        writer.writerow(["AccountId", TOTAL, LICENSE_INCLUDED, MARKETPLACE, BYOL, TOTAL_ERRORS, STS_ERRORS, EC2_ERRORS,
-                         SSM_ERRORS])
-        for key in keys:
-            summary[key][TOTAL] = summary[key][LICENSE_INCLUDED] + summary[key][MARKETPLACE] + summary[key][BYOL]
-            summary[key][TOTAL_ERRORS] = summary[key][STS_ERRORS] + summary[key][EC2_ERRORS] + summary[key][SSM_ERRORS]
-            row = [value for value in summary[key].values()]
-            row = [key] + row
-            writer.writerow(row)
+def create_summary(all_accounts, output_formats=(CSV,)):
+    summary['ALL'] = initialize_summary()
+    for key in summary['ALL'].keys():
+        summary['ALL'][key] = sum([summary[account][key] for account in all_accounts])
+    keys = ['ALL'] + all_accounts
+    fields = ["AccountId", TOTAL, LICENSE_INCLUDED, MARKETPLACE, BYOL, TOTAL_ERRORS, STS_ERRORS, EC2_ERRORS,
+              SSM_ERRORS, BYOL_CORES]
+    rows = []
+    for key in keys:
+        summary[key][TOTAL] = summary[key][LICENSE_INCLUDED] + summary[key][MARKETPLACE] + summary[key][BYOL]
+        summary[key][TOTAL_ERRORS] = summary[key][STS_ERRORS] + summary[key][EC2_ERRORS] + summary[key][SSM_ERRORS]
+        row = [value for value in summary[key].values()]
+        rows.append([key] + row)
+    if CSV in output_formats:
+        with open("summary.csv", 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(fields)
+            writer.writerows(rows)
+    for output_format in output_formats:
+        if output_format in COLUMNAR_EXTENSIONS:
+            write_columnar_table("summary" + COLUMNAR_EXTENSIONS[output_format], output_format, fields, rows,
+                                 integer_fields=fields[1:])
 
 
 def write_report():
     with open("report.txt", "w") as report_fp:
         if len(misconfigured_accounts) != 0:
             report_fp.write("The following accounts are not provisioned the correct permissions: \n")
-            for account in misconfigured_accounts:
+            for account in sorted(misconfigured_accounts):
                 report_fp.write(account + '\n')
             report_fp.write('\n')
         if summary['ALL'][TOTAL_ERRORS] == 0:
@@ -320,33 +587,161 @@ def write_report():
             report_fp.write("\n\n")
 
 
-def main(command_line=None):
+def parse_arguments(command_line):
+    parser = argparse.ArgumentParser(description="Gathers EC2 instance data across the organization")
+    parser.add_argument("--shard", type=parse_shard, metavar="K/N",
+                        help="Only crawl the accounts of shard K of N, picked by a hash of the account ID; "
+                             "merge the shards with orgwide_instances_shards.py")
+    parser.add_argument("--resume", action="store_true",
+                        help="Reuse the units completed by an interrupted run from the checkpoint journal")
+    parser.add_argument("--journal", default=DEFAULT_JOURNAL_PATH, help="Checkpoint journal path")
+    parser.add_argument("--sample", type=parse_fraction, metavar="FRACTION",
+                        help="Only crawl a stratified random sample of this fraction of the accounts and estimate "
+                             "the organization totals in summary_estimate.csv")
+    parser.add_argument("--sample-budget", type=float, metavar="SECONDS",
+                        help="Size the sample to crawl in about this many seconds, from the previous runs")
+    parser.add_argument("--sample-seed", type=int, default=DEFAULT_SAMPLE_SEED,
+                        help="The same seed, accounts and history give the same sample")
+    parser.add_argument("--sample-strata", choices=[OU_STRATA, SIZE_STRATA],
+                        help="Stratify by top-level OU of \"ou_ids\" or by instance count in previous runs; "
+                             "defaults to ou when \"ou_ids\" has several OUs, size otherwise")
+    return parser.parse_args(command_line)
+
+
+def get_sample_strata(accounts, strata_type, account_instances):
+    if strata_type == OU_STRATA:
+        if inputs['ou_ids']:
+            # The tree was walked, or read from the cache, while listing the accounts
+            return get_ou_strata(accounts, get_org_tree(get_org_client(rate_limited=True)))
+        print("WARNING - OU strata need \"ou_ids\"; stratifying by size")
+    return get_size_strata(accounts, account_instances)
+
+
+def select_sample_accounts(accounts, args):
+    # Returns the sampled accounts and the stratum of every account. The previous runs' instance counts
+    # stratify by size and allocate the sample; their durations size a --sample-budget sample.
+    account_totals = UnitHistory(DEFAULT_HISTORY_PATH).get_account_totals()
+    account_instances = {account: totals["instances"] for account, totals in account_totals.items()}
+    sample_size = None
+    if args.sample_budget is not None:
+        sample_size = get_budget_sample_size(accounts, {account: totals["seconds"]
+                                                        for account, totals in account_totals.items()},
+                                             args.sample_budget, inputs.get("max_workers", DEFAULT_MAX_WORKERS))
+        if sample_size is None and args.sample is None:
+            print("No previous run to size a sample budget from; use --sample")
+            exit()
+    if sample_size is None:
+        sample_size = max(1, round(args.sample * len(accounts)))
+    strata = get_sample_strata(accounts, args.sample_strata or (OU_STRATA if len(inputs['ou_ids']) > 1
+                                                                else SIZE_STRATA), account_instances)
+    strata = merge_small_strata(strata, sample_size)
+    return select_sample(accounts, strata, sample_size, args.sample_seed, account_instances), strata
+
+
+def main(command_line=None, context=None):
     print("Start of the Org Wide Instance Aggregator")
 
-    global inputs
-    inputs = get_inputs()
-
-    all_accounts = list_all_accounts()
+    global inputs, rate_limiter, journal
+    args = parse_arguments(command_line)
+    context = get_context(context)
+    inputs = context.inputs
+    rate_limiter = get_rate_limiter()
+    output_formats = inputs.get("output_formats", [CSV])
+    rollups = inputs.get("rollups", [])
+    error = check_output_formats(output_formats) or check_rollups(rollups)
+    sampling = args.sample is not None or args.sample_budget is not None
+    if error is None and args.shard is not None and CSV not in output_formats:
+        error = "Sharded runs need the csv output format to be merged"
+    if error is None and args.shard is not None and sampling:
+        error = "--sample cannot be combined with --shard"
+    if error is not None:
+        print(error)
+        exit()
+
+    organization_accounts = list_all_accounts()
+    all_accounts = organization_accounts
+    if args.shard is not None:
+        all_accounts = select_shard_accounts(organization_accounts, *args.shard)
+        print("Shard " + str(args.shard[0]) + " of " + str(args.shard[1]) + ": " + str(len(all_accounts)) + " of " +
+              str(len(organization_accounts)) + " accounts")
+    if sampling:
+        all_accounts, strata = select_sample_accounts(organization_accounts, args)
+        print("Sample of " + str(len(all_accounts)) + " of " + str(len(organization_accounts)) + " accounts from " +
+              str(len(set(strata.values()))) + " strata, seed " + str(args.sample_seed))
     print("Attempting to gather data from " + str(len(all_accounts)) + " accounts")
 
     for account in all_accounts:
         summary[account] = initialize_summary()
         error_messages[account] = initialize_error_message()
 
-    if inputs["automatic_member_role_creation"] and inputs["check_stack_set_status"]:
-        print("Checking stack set status")
-        check_stack_set_status()
-
-    categorized_ec2_instances = categorize_ec2_instances(all_accounts)
+    # The stack set drift check runs alongside the crawl; its findings are merged once both are done
+    with ThreadPoolExecutor(max_workers=1) as background:
+        stack_set_check = None
+        if inputs["automatic_member_role_creation"] and inputs["check_stack_set_status"]:
+            print("Checking stack set status")
+            stack_set_check = background.submit(check_stack_set_status)
+
+        store = InventoryStore(inputs.get("inventory_store", DEFAULT_STORE_PATH))
+        print("Storing instances as regions complete, run " + str(store.start_run()) + " in " + store.path)
+        # The category CSVs get their rows and the Parquet and Arrow files their row groups as the crawl
+        # progresses, in unit order
+        writers = []
+        try:
+            if CSV in output_formats:
+                writers.append(CategoryCsvWriter())
+            for output_format in output_formats:
+                if output_format in COLUMNAR_EXTENSIONS:
+                    writers.append(CategoryColumnarWriter(output_format, inputs.get("row_group_size",
+                                                                                    DEFAULT_ROW_GROUP_SIZE)))
+            with CheckpointJournal(args.journal, resume=args.resume) as journal:
+                journal.record_run(all_accounts)
+                categorize_ec2_instances(all_accounts, store, writers, context)
+                if args.resume:
+                    print("Replayed " + str(journal.get_stats()["replayed"]) + " completed units from " +
+                          args.journal)
+        finally:
+            for writer in writers:
+                writer.close()
+
+        if stack_set_check is not None:
+            try:
+                merge_stack_set_status(all_accounts, stack_set_check.result())
+            except Exception as Argument:
+                print("WARNING - Could not check stack set status: " + str(Argument))
 
-    print("Creating categorized CSVs")
-    output_csv(categorized_ec2_instances)
 
     print("Creating a summary of findings")
-    create_summary(all_accounts)
+    create_summary(all_accounts, output_formats)
+    store.write_accounts(all_accounts, summary, error_messages)
+    store.finish_run("sample" if sampling else "shard" if args.shard is not None else "complete")
+
+    if sampling:
+        estimates, responding = estimate_totals(organization_accounts, strata, all_accounts, summary)
+        write_summary_estimate(estimates, responding, len(organization_accounts))
+        print("Estimated totals from " + str(responding) + " accounts: " + ", ".join(
+            metric + " " + str(round(estimate["Estimate"])) + " (" + str(math.floor(estimate["Lower"])) + "-" +
+            str(math.ceil(estimate["Upper"])) + ")" for metric, estimate in estimates.items()))
+    elif inputs.get("diff_with_previous_run", True):
+        print("Comparing with the previous run")
+        changes = write_run_diff(store, store.run_id)
+        if changes is not None:
+            print("Changes since the previous run: " + str(changes[ADDED]) + " added, " + str(changes[REMOVED]) +
+                  " removed, " + str(changes[RECATEGORIZED]) + " recategorized")
+    if rollups:
+        print("Writing " + str(len(rollups)) + " rollups")
+        write_rollups(store, store.run_id, rollups, output_formats)
+    store.close()
 
     print("Creating report")
     write_report()
+    write_throttling_report()
+    if args.shard is not None:
+        write_shard_manifest(args.shard[0], args.shard[1], organization_accounts, all_accounts, summary,
+                             error_messages, misconfigured_accounts)
+
+    print("Writing API metrics")
+    api_metrics.write_json("metrics.json")
+    api_metrics.write_prometheus("metrics.prom")
 
 
 if __name__ == '__main__':
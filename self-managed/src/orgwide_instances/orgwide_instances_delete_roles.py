@@ -1,4 +1,5 @@
 from orgwide_instances_utils import *
+from orgwide_instances_pipeline import get_context
 
 
 def delete_stack_set(account_id):
@@ -25,11 +26,11 @@ def delete_stack_set(account_id):
     cf_client.delete_stack_set(StackSetName=inputs["stack_set_name"], CallAs=caller)
 
 
-def main(command_line=None):
+def main(command_line=None, context=None):
     print("Deleting roles and policies throughout member accounts")
 
     global inputs
-    inputs = get_inputs()
+    inputs = get_context(context).inputs
 
     manager_account_id = get_current_account_id()
 
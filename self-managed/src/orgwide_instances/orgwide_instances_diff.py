@@ -0,0 +1,117 @@
+import argparse
+import csv
+import os
+from collections import Counter
+from orgwide_instances_utils import LICENSE_INCLUDED, MARKETPLACE, BYOL
+from orgwide_instances_store import InventoryStore, DEFAULT_STORE_PATH
+
+ADDED = "added"
+REMOVED = "removed"
+RECATEGORIZED = "recategorized"
+CHANGE_FIELDS = ["ChangeType", "AccountId", "Region", "InstanceId", "PreviousCategory", "Category",
+                 "PlatformDetails", "InstanceType", "InstanceStateName"]
+CHANGE_SUMMARY_FIELDS = ["AccountId", ADDED, REMOVED, RECATEGORIZED, LICENSE_INCLUDED, MARKETPLACE, BYOL]
+# Columns read from the store for each instance; the first one is the join key
+JOIN_COLUMNS = ["InstanceId", "AccountId", "Region", "category", "PlatformDetails", "InstanceType",
+                "InstanceStateName"]
+# Instance IDs are "i-" followed by hex digits; each partition covers one leading digit, plus one partition
+# below and one above them for anything else
+PARTITION_BOUNDARIES = ["i-" + digit for digit in "0123456789abcdef"]
+
+
+def get_partitions():
+    boundaries = [None] + PARTITION_BOUNDARIES + [None]
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def diff_runs(store, base_run_id, run_id, accounts):
+    # Yields (change type, previous row, current row) for every instance of accounts added, removed or moved
+    # to another category between two runs. Partitioned hash join on the instance ID: for each range of
+    # instance IDs the base run's instances are loaded into a dict and the current run's instances are
+    # streamed against it, so only one partition of one run is in memory at a time.
+    for low, high in get_partitions():
+        previous = {row[0]: row for row in store.iterate_instance_range(base_run_id, JOIN_COLUMNS, low, high)
+                    if row[1] in accounts}
+        for row in store.iterate_instance_range(run_id, JOIN_COLUMNS, low, high):
+            if row[1] not in accounts:
+                continue
+            previous_row = previous.pop(row[0], None)
+            if previous_row is None:
+                yield ADDED, None, row
+            elif previous_row[3] != row[3]:
+                yield RECATEGORIZED, previous_row, row
+        for instance_id in sorted(previous):
+            yield REMOVED, previous[instance_id], None
+
+
+def write_changes(changes, path="changes.csv"):
+    # Streams the changes to changes.csv and returns the per-account counts and category deltas
+    deltas = dict()
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(CHANGE_FIELDS)
+        for change_type, previous_row, row in changes:
+            instance_id, account, region, category, platform_details, instance_type, state = row or previous_row
+            previous_category = previous_row[3] if previous_row else ""
+            writer.writerow([change_type, account, region, instance_id, previous_category,
+                             row[3] if row else "", platform_details, instance_type, state])
+            account_deltas = deltas.setdefault(account, Counter())
+            account_deltas[change_type] += 1
+            if previous_row:
+                account_deltas[previous_row[3]] -= 1
+            if row:
+                account_deltas[row[3]] += 1
+    return deltas
+
+
+def write_changes_summary(deltas, path="changes_summary.csv"):
+    # Same layout as summary.csv: an ALL row followed by one row per account with changes
+    total = Counter()
+    for account_deltas in deltas.values():
+        total.update(account_deltas)
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(CHANGE_SUMMARY_FIELDS)
+        for account, account_deltas in [("ALL", total)] + sorted(deltas.items()):
+            writer.writerow([account] + [account_deltas[field] for field in CHANGE_SUMMARY_FIELDS[1:]])
+    return total
+
+
+def write_run_diff(store, run_id, base_run_id=None):
+    # Diffs run_id against base_run_id, by default the latest complete run before it. Only accounts crawled in
+    # both runs are compared, so a shard or an account list that changed does not show up as removed
+    # instances. Accounts that had role or EC2 errors in either run are left out too, since their inventory is
+    # incomplete. Returns the totals, or None when there is no run to compare with.
+    if base_run_id is None:
+        base_run_id = store.get_previous_run_id(run_id)
+    if base_run_id is None:
+        return None
+    accounts = store.get_accounts(base_run_id) & store.get_accounts(run_id)
+    skipped_accounts = accounts & (store.get_accounts_with_errors(base_run_id) |
+                                   store.get_accounts_with_errors(run_id))
+    if skipped_accounts:
+        print("Leaving " + str(len(skipped_accounts)) + " accounts with errors out of the comparison")
+    deltas = write_changes(diff_runs(store, base_run_id, run_id, accounts - skipped_accounts))
+    return write_changes_summary(deltas)
+
+
+def main(command_line=None):
+    parser = argparse.ArgumentParser(description="Writes changes.csv and changes_summary.csv for two runs kept in "
+                                                 "the inventory store")
+    parser.add_argument("--store", default=DEFAULT_STORE_PATH)
+    parser.add_argument("--run-id", type=int, help="Defaults to the latest complete run")
+    parser.add_argument("--base-run-id", type=int, help="Defaults to the latest complete run before --run-id")
+    args = parser.parse_args(command_line)
+
+    with InventoryStore(args.store) as store:
+        run_id = args.run_id if args.run_id is not None else store.get_latest_run_id()
+        total = write_run_diff(store, run_id, args.base_run_id) if run_id is not None else None
+    if total is None:
+        print("No runs to compare in " + args.store)
+        return
+    print("Changes: " + str(total[ADDED]) + " added, " + str(total[REMOVED]) + " removed, " +
+          str(total[RECATEGORIZED]) + " recategorized; see " + os.path.abspath("changes.csv"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import contextlib
+import heapq
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+DEFAULT_MAX_WORKERS = 32
+DEFAULT_MAX_WORKERS_PER_ACCOUNT = 4
+DEFAULT_MAX_CHUNK_WORKERS = 16
+# Units allowed to run ahead of the oldest unfinished unit, per worker
+WINDOW_PER_WORKER = 8
+
+
+class FanOutExecutor:
+    # Bounded worker pool for (account, region) units. Accounts are drained in order, each one
+    # limited to max_workers_per_account units in flight; API calls are additionally limited per service.
+    # No unit starts more than max_workers * WINDOW_PER_WORKER units after the oldest unfinished one, which
+    # bounds how many finished results a consumer releasing them in order has to buffer.
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, max_workers_per_account=DEFAULT_MAX_WORKERS_PER_ACCOUNT,
+                 max_workers_per_service=None, max_chunk_workers=DEFAULT_MAX_CHUNK_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self.max_workers_per_account = max(1, max_workers_per_account)
+        self.service_semaphores = {service: threading.BoundedSemaphore(max(1, limit))
+                                   for service, limit in (max_workers_per_service or {}).items()}
+        # Separate pool for requests a unit splits into chunks, so units never wait on their own pool
+        self.chunk_pool = ThreadPoolExecutor(max_workers=max(1, max_chunk_workers))
+
+    def service_slot(self, service):
+        semaphore = self.service_semaphores.get(service)
+        if semaphore is None:
+            return contextlib.nullcontext()
+        return semaphore
+
+    def map_chunks(self, function, items, chunk_size):
+        # Calls function on consecutive chunks of items concurrently and returns the results in chunk order
+        chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+        if len(chunks) <= 1:
+            return [function(chunk) for chunk in chunks]
+        return list(self.chunk_pool.map(function, chunks))
+
+    def prefetch(self, iterable):
+        # Iterates one item ahead of the caller on the chunk pool, so the next item (e.g. the next API page) is
+        # fetched while the caller works on the current one. A fetch the pool has not started by the time the
+        # caller needs it runs on the caller's thread instead. When the caller stops early, a fetch in flight is
+        # waited for and the iterator closed.
+        iterator = iter(iterable)
+        end = object()
+        pending = self.chunk_pool.submit(next, iterator, end)
+        try:
+            while True:
+                item = next(iterator, end) if pending.cancel() else pending.result()
+                if item is end:
+                    return
+                pending = self.chunk_pool.submit(next, iterator, end)
+                yield item
+        finally:
+            if not pending.cancel():
+                wait([pending])
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    def close(self):
+        self.chunk_pool.shutdown()
+
+    def run(self, function, units, ranks=None):
+        # Yields (index, result) for function(*unit) as each unit finishes. The first element of each
+        # unit is its account. Units start in the order of their rank, a permutation of the unit indexes
+        # that defaults to unit order; the run-ahead window is measured in ranks.
+        if ranks is None:
+            ranks = range(len(units))
+        queues = dict()
+        for index in sorted(range(len(units)), key=lambda unit_index: ranks[unit_index]):
+            queues.setdefault(units[index][0], deque()).append(index)
+        # Accounts that may start a unit, keyed by the rank of their next unit
+        ready = [(ranks[queue[0]], account) for account, queue in queues.items()]
+        heapq.heapify(ready)
+        in_flight = {account: 0 for account in queues}
+        running = dict()
+        finished = [False] * len(units)
+        oldest_unfinished = 0
+        window = self.max_workers * WINDOW_PER_WORKER
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while ready or running:
+                while ready and len(running) < self.max_workers:
+                    if running and ready[0][0] >= oldest_unfinished + window:
+                        break
+                    _, account = heapq.heappop(ready)
+                    index = queues[account].popleft()
+                    in_flight[account] += 1
+                    running[pool.submit(function, *units[index])] = (index, account)
+                    if queues[account] and in_flight[account] < self.max_workers_per_account:
+                        heapq.heappush(ready, (ranks[queues[account][0]], account))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=lambda completed: ranks[running[completed][0]]):
+                    index, account = running.pop(future)
+                    in_flight[account] -= 1
+                    finished[ranks[index]] = True
+                    while oldest_unfinished < len(units) and finished[oldest_unfinished]:
+                        oldest_unfinished += 1
+                    if queues[account] and in_flight[account] == self.max_workers_per_account - 1:
+                        heapq.heappush(ready, (ranks[queues[account][0]], account))
+                    yield index, future.result()
+
+
+class OrderedResults:
+    # Reorder buffer: accepts results in completion order and releases them in unit order
+    def __init__(self):
+        self.next_index = 0
+        self.buffered = dict()
+
+    def add(self, index, result):
+        self.buffered[index] = result
+        released = []
+        while self.next_index in self.buffered:
+            released.append(self.buffered.pop(self.next_index))
+            self.next_index += 1
+        return released
+
@@ -0,0 +1,174 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from orgwide_instances_utils import LICENSE_INCLUDED, BYOL
+
+REGION_NAMES = ["us-east-1", "us-east-2", "us-west-1", "us-west-2", "ca-central-1", "eu-central-1", "eu-west-1",
+                "eu-west-2", "eu-west-3", "eu-north-1", "ap-south-1", "ap-northeast-1", "ap-northeast-2",
+                "ap-northeast-3", "ap-southeast-1", "ap-southeast-2", "sa-east-1"]
+INSTANCE_TYPES = ["t3.micro", "t3.large", "m5.large", "m5.xlarge", "c5.2xlarge", "r5.4xlarge", "m6i.8xlarge"]
+PLATFORMS = [("Ubuntu", "Linux", "22.04"), ("Amazon Linux", "Linux", "2023"),
+             ("Microsoft Windows Server 2022 Datacenter", "Windows", "10.0.20348")]
+
+
+class FakeOrganization:
+    # In-process stand-in for Organizations, STS, EC2 and SSM used by the offline benchmarks. Accounts,
+    # regions and instances are generated deterministically from the seed; the instance mix is based on
+    # the templates in self-managed/src/sample.json and the usage operations in billing_codes.json.
+    def __init__(self, accounts, regions, instances_per_region, seed=0, latency=0.0,
+                 sample_path="../sample.json", billing_codes_path="billing_codes.json",
+                 license_included_codes_path="license_included_codes.json", ssm_managed_ratio=0.8):
+        self.account_ids = ["%012d" % (100000000000 + index) for index in range(accounts)]
+        self.regions = [REGION_NAMES[index] if index < len(REGION_NAMES) else "fake-region-%d" % index
+                        for index in range(regions)]
+        self.region_indexes = {region: index for index, region in enumerate(self.regions)}
+        self.instances_per_region = instances_per_region
+        self.seed = seed
+        self.latency = latency
+        self.ssm_managed_ratio = ssm_managed_ratio
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        with open(sample_path) as fp:
+            sample = json.load(fp)
+        with open(billing_codes_path) as fp:
+            billing_codes = json.load(fp)
+        with open(license_included_codes_path) as fp:
+            self.platform_details = json.load(fp)
+        self.marketplace_templates = [instance for instance in sample["marketplace"] if instance.get("ProductCodes")]
+        self.license_included_templates = [instance for instance in sample["license_included"]
+                                           if not instance.get("ProductCodes")]
+        self.license_included_templates += [{"UsageOperation": code} for code in billing_codes[LICENSE_INCLUDED]]
+        self.byol_templates = [{"UsageOperation": code} for code in billing_codes[BYOL]]
+        self.byol_templates += [{"UsageOperation": code} for code in ["RunInstances:0800", "RunInstances:00g0"]]
+
+    def record_call(self, service, operation):
+        with self.lock:
+            self.calls[service + ":" + operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_instances(self, account, region):
+        # A realistic mix: about 20% Marketplace, 50% license included and 30% BYOL
+        rnd = random.Random("%s:%s:%s" % (self.seed, account, region))
+        instances = []
+        for index in range(self.instances_per_region):
+            choice = rnd.random()
+            if choice < 0.2:
+                template = rnd.choice(self.marketplace_templates)
+            elif choice < 0.7:
+                template = rnd.choice(self.license_included_templates)
+            else:
+                template = rnd.choice(self.byol_templates)
+            instances.append({
+                "InstanceId": "i-%s%04d%06d" % (account[-4:], self.region_indexes[region], index),
+                "ImageId": "ami-%017x" % rnd.getrandbits(64),
+                "InstanceType": rnd.choice(INSTANCE_TYPES),
+                "PlatformDetails": self.platform_details.get(template["UsageOperation"], "Linux/UNIX"),
+                "UsageOperation": template["UsageOperation"],
+                "ProductCodes": [dict(code) for code in template.get("ProductCodes", [])],
+                "State": {"Code": 16, "Name": "running"},
+                "CpuOptions": {"CoreCount": 2, "ThreadsPerCore": 2},
+                "Placement": {"AvailabilityZone": region + "a", "Tenancy": "default"},
+                "NetworkInterfaces": [{"NetworkInterfaceId": "eni-%017x" % rnd.getrandbits(64)}],
+                "Tags": [{"Key": "Name", "Value": "benchmark-%d" % index}]
+            })
+        return instances
+
+    def get_org_client(self, rate_limited=False):
+        return FakeOrganizationsClient(self)
+
+    def get_client_cache(self):
+        return FakeClientCache(self)
+
+
+class FakeOrganizationsClient:
+    def __init__(self, organization):
+        self.organization = organization
+
+    def list_accounts(self, NextToken=None):
+        self.organization.record_call("organizations", "ListAccounts")
+        start = int(NextToken or 0)
+        page = self.organization.account_ids[start:start + 20]
+        response = {"Accounts": [{"Id": account, "Status": "ACTIVE"} for account in page]}
+        if start + 20 < len(self.organization.account_ids):
+            response["NextToken"] = str(start + 20)
+        return response
+
+
+class FakeEc2Client:
+    def __init__(self, organization, account, region):
+        self.organization = organization
+        self.account = account
+        self.region = region
+
+    def describe_regions(self, **kwargs):
+        self.organization.record_call("ec2", "DescribeRegions")
+        return {"Regions": [{"RegionName": region, "OptInStatus": "opt-in-not-required"}
+                            for region in self.organization.regions]}
+
+    def describe_instances(self, MaxResults=1000, NextToken=None, **kwargs):
+        self.organization.record_call("ec2", "DescribeInstances")
+        instances = self.organization.get_instances(self.account, self.region)
+        start = int(NextToken or 0)
+        response = {"Reservations": [{"ReservationId": "r-%d" % index, "Instances": [instance]}
+                                     for index, instance in enumerate(instances[start:start + MaxResults])]}
+        if start + MaxResults < len(instances):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+
+class FakeSsmClient:
+    def __init__(self, organization, account, region):
+        self.organization = organization
+        self.account = account
+        self.region = region
+
+    def describe_instance_information(self, Filters, MaxResults=50, NextToken=None, **kwargs):
+        self.organization.record_call("ssm", "DescribeInstanceInformation")
+        instance_ids = sorted(value for instance_filter in Filters if instance_filter["Key"] == "InstanceIds"
+                              for value in instance_filter["Values"])
+        managed = [instance_id for instance_id in instance_ids
+                   if random.Random(instance_id).random() < self.organization.ssm_managed_ratio]
+        start = int(NextToken or 0)
+        response = {"InstanceInformationList": []}
+        for instance_id in managed[start:start + MaxResults]:
+            platform_name, platform_type, platform_version = random.Random(instance_id).choice(PLATFORMS)
+            response["InstanceInformationList"].append({"InstanceId": instance_id, "PlatformName": platform_name,
+                                                        "PlatformType": platform_type,
+                                                        "PlatformVersion": platform_version})
+        if start + MaxResults < len(managed):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+
+class FakeClientCache:
+    # Same interface as ClientCache, handing out fake member account clients
+    def __init__(self, organization):
+        self.organization = organization
+        self.clients = dict()
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_session(self, account):
+        self.organization.record_call("sts", "AssumeRole")
+        return account
+
+    def get_client(self, account, region, service):
+        with self.lock:
+            key = (account, region, service)
+            if key not in self.clients:
+                client_type = FakeEc2Client if service == "ec2" else FakeSsmClient
+                self.clients[key] = client_type(self.organization, account, region)
+                self.misses += 1
+            return self.clients[key]
+
+    def release_account(self, account):
+        with self.lock:
+            for key in [key for key in self.clients if key[0] == account]:
+                del self.clients[key]
+
+    def get_stats(self):
+        return {"hits": 0, "misses": self.misses, "sessions": len(self.organization.account_ids),
+                "credential_refreshes": 0}
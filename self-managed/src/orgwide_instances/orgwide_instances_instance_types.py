@@ -0,0 +1,106 @@
+import json
+import os
+import threading
+import time
+
+DEFAULT_CATALOG_PATH = "instance_types.json"
+DEFAULT_CATALOG_TTL = 604800
+DESCRIBE_INSTANCE_TYPES_PAGE_SIZE = 100
+
+
+def get_cpu_info(instance_type):
+    # The default vCPUs, cores and threads per core of one DescribeInstanceTypes entry
+    vcpu_info = instance_type.get("VCpuInfo", {})
+    vcpus = vcpu_info.get("DefaultVCpus")
+    threads_per_core = vcpu_info.get("DefaultThreadsPerCore", 1)
+    cores = vcpu_info.get("DefaultCores", vcpus // threads_per_core if vcpus else None)
+    return {"vcpus": vcpus, "cores": cores, "threads_per_core": threads_per_core}
+
+
+class InstanceTypeCatalog:
+    # Default vCPUs, cores and threads per core of every instance type, keyed by type name. The catalog is built
+    # with one paginated DescribeInstanceTypes the first time an instance has no CpuOptions, kept on disk for
+    # ttl seconds and shared by every account and region. Types missing from it, e.g. ones offered only in
+    # another region, are described on their own once per run.
+    def __init__(self, path=DEFAULT_CATALOG_PATH, ttl=DEFAULT_CATALOG_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.types, self.time = self.load()
+        self.built = False
+        self.described = set()
+        self.failed = False
+        self.stats = {"catalog_lookups": 0, "described_types": 0, "unknown_types": 0}
+
+    def load(self):
+        if not self.path or self.ttl <= 0:
+            return dict(), 0
+        try:
+            with open(self.path) as fp:
+                catalog = json.load(fp)
+        except (OSError, ValueError):
+            return dict(), 0
+        return catalog["types"], catalog["time"]
+
+    def save(self):
+        if not self.path or self.ttl <= 0 or not self.types:
+            return
+        with self.lock:
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as fp:
+                json.dump({"types": self.types, "time": self.time}, fp, sort_keys=True)
+            os.replace(temporary_path, self.path)
+
+    def is_fresh(self):
+        # A catalog built by this run is used until the run ends, whatever the ttl
+        return self.built or bool(self.types) and time.time() - self.time < self.ttl
+
+    def build(self, describe):
+        # describe(**request) calls DescribeInstanceTypes and returns the response
+        types = dict()
+        request = {"MaxResults": DESCRIBE_INSTANCE_TYPES_PAGE_SIZE}
+        while True:
+            response = describe(**request)
+            for instance_type in response["InstanceTypes"]:
+                types[instance_type["InstanceType"]] = get_cpu_info(instance_type)
+            if "NextToken" not in response:
+                break
+            request["NextToken"] = response["NextToken"]
+        self.types, self.time, self.built = types, time.time(), True
+
+    def get(self, instance_type, describe):
+        # CPU info of the instance type, or None when it cannot be described. The lock is only held while the
+        # catalog is built or a missing type described, which happens a handful of times per run.
+        if instance_type is None:
+            return None
+        entry = self.types.get(instance_type)
+        if entry is not None and self.is_fresh():
+            self.count("catalog_lookups")
+            return entry
+        with self.lock:
+            if not self.is_fresh() and not self.failed:
+                try:
+                    self.build(describe)
+                except Exception as Argument:
+                    # Types are then described one at a time, still once per run each
+                    self.failed = True
+                    print("WARNING - Could not build the instance type catalog: " + str(Argument))
+            entry = self.types.get(instance_type)
+            if entry is None and instance_type not in self.described:
+                self.described.add(instance_type)
+                self.stats["described_types"] += 1
+                try:
+                    for described_type in describe(InstanceTypes=[instance_type])["InstanceTypes"]:
+                        entry = self.types[instance_type] = get_cpu_info(described_type)
+                except Exception as Argument:
+                    print("WARNING - Could not describe instance type " + instance_type + ": " + str(Argument))
+            self.stats["catalog_lookups" if entry is not None else "unknown_types"] += 1
+            return entry
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, instance_types=len(self.types))
@@ -0,0 +1,109 @@
+import json
+import threading
+from orgwide_instances_records import record_types
+
+DEFAULT_JOURNAL_PATH = "checkpoint.jsonl"
+
+
+class CheckpointJournal:
+    # Append-only JSON lines journal of finished crawl units. Every line holds the result of one account
+    # setup ("account") or one (account, region) unit ("unit"): its summary deltas, error messages and, for
+    # units, its CSV rows. A resumed run replays the journaled results in place of the API calls. Only the
+    # offsets of journaled lines are kept in memory; results are read back when their unit comes up.
+    def __init__(self, path=DEFAULT_JOURNAL_PATH, resume=False):
+        self.path = path
+        self.offsets = dict()
+        self.accounts = None
+        self.replayed = 0
+        self.lock = threading.Lock()
+        if resume:
+            self.load()
+            self.reader = open(self.path, "rb")
+            self.writer = open(self.path, "ab")
+        else:
+            self.reader = None
+            self.writer = open(self.path, "wb")
+
+    def load(self):
+        valid_end = 0
+        try:
+            with open(self.path, "rb") as fp:
+                while True:
+                    offset = fp.tell()
+                    line = fp.readline()
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    if entry["type"] == "run":
+                        self.accounts = entry["accounts"]
+                    else:
+                        self.offsets[(entry["account"], entry.get("region"))] = offset
+                    valid_end = fp.tell()
+        except FileNotFoundError:
+            pass
+        # A line cut short when the previous run died is dropped before appending to the journal
+        with open(self.path, "ab") as fp:
+            fp.truncate(valid_end)
+
+    def read_entry(self, key):
+        offset = self.offsets.get(key)
+        if offset is None or self.reader is None:
+            return None
+        with self.lock:
+            self.reader.seek(offset)
+            entry = json.loads(self.reader.readline())
+            self.replayed += 1
+        result = entry["result"]
+        result["categorized_ec2"] = {category: [record_types[category]._make(row) for row in rows]
+                                     for category, rows in result["categorized_ec2"].items()}
+        return entry
+
+    def get_account(self, account):
+        # (result, regions) of a journaled account setup, or None
+        entry = self.read_entry((account, None))
+        if entry is None:
+            return None
+        return entry["result"], entry["regions"]
+
+    def get_unit(self, account, region):
+        entry = self.read_entry((account, region))
+        if entry is None:
+            return None
+        return entry["result"]
+
+    def append(self, entry):
+        self.writer.write(json.dumps(entry, separators=(",", ":")).encode() + b"\n")
+        self.writer.flush()
+
+    def record_run(self, accounts):
+        if self.accounts is not None and self.accounts != accounts:
+            print("WARNING - The account list changed since the checkpoint journal was written; journaled units "
+                  "of accounts that are still listed are reused")
+        self.append({"type": "run", "accounts": accounts})
+
+    def record_account(self, result, regions):
+        if (result["account"], None) not in self.offsets:
+            self.append({"type": "account", "account": result["account"], "result": result, "regions": regions})
+
+    def record_unit(self, result):
+        if (result["account"], result["region"]) not in self.offsets:
+            self.append({"type": "unit", "account": result["account"], "region": result["region"],
+                         "result": result})
+
+    def get_stats(self):
+        with self.lock:
+            return {"journaled": len(self.offsets), "replayed": self.replayed}
+
+    def close(self):
+        self.writer.close()
+        if self.reader is not None:
+            self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
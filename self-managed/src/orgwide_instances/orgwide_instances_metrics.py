@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+from array import array
+from functools import partial
+
+QUANTILES = [0.5, 0.95, 0.99]
+METRIC_PREFIX = "orgwide_instances_api"
+
+
+def get_operation_name(function):
+    # Bound client methods are named after the operation in snake case, e.g. describe_instances
+    return "".join(part.title() for part in getattr(function, "__name__", "unknown").split("_"))
+
+
+def get_quantile(sorted_values, quantile):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(quantile * len(sorted_values)))]
+
+
+class ApiMetrics:
+    # Per-operation API call instrumentation recorded through botocore event hooks, tagged by account and
+    # region: calls, successful pages, errors, retries, response bytes and latencies
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = dict()
+
+    def get_series(self, service, operation, account, region):
+        key = (service, operation, account or "", region or "")
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = {"calls": 0, "pages": 0, "errors": 0, "retries": 0, "response_bytes": 0,
+                                         "latencies": array("d")}
+        return series
+
+    def register(self, client, account, region):
+        events = getattr(getattr(client, "meta", None), "events", None)
+        if events is None:
+            return client
+        events.register("before-call", partial(self.before_call, account=account, region=region))
+        events.register("after-call", partial(self.after_call, account=account, region=region))
+        events.register("after-call-error", partial(self.after_call_error, account=account, region=region))
+        return client
+
+    def before_call(self, event_name=None, context=None, **kwargs):
+        if context is not None:
+            context["metrics_start"] = time.perf_counter()
+
+    def after_call(self, event_name=None, http_response=None, parsed=None, context=None, account=None, region=None,
+                   **kwargs):
+        _, service, operation = event_name.split(".", 2)
+        latency = time.perf_counter() - context["metrics_start"] if context and "metrics_start" in context else None
+        content = getattr(http_response, "content", None) or b""
+        status_code = getattr(http_response, "status_code", 200)
+        with self.lock:
+            series = self.get_series(service, operation, account, region)
+            series["calls"] += 1
+            series["response_bytes"] += len(content)
+            if status_code < 300:
+                series["pages"] += 1
+            else:
+                series["errors"] += 1
+            if latency is not None:
+                series["latencies"].append(latency)
+
+    def after_call_error(self, event_name=None, context=None, account=None, region=None, **kwargs):
+        _, service, operation = event_name.split(".", 2)
+        latency = time.perf_counter() - context["metrics_start"] if context and "metrics_start" in context else None
+        with self.lock:
+            series = self.get_series(service, operation, account, region)
+            series["calls"] += 1
+            series["errors"] += 1
+            if latency is not None:
+                series["latencies"].append(latency)
+
+    def record_retry(self, key, operation):
+        # Retry listener for RateLimiter; key is (account, service, region)
+        account, service, region = key
+        with self.lock:
+            self.get_series(service, operation, account, region)["retries"] += 1
+
+    def summarize(self, series):
+        latencies = sorted(series["latencies"])
+        summary = {key: series[key] for key in ("calls", "pages", "errors", "retries", "response_bytes")}
+        summary["latency_seconds"] = {"count": len(latencies), "sum": round(sum(latencies), 6)}
+        for quantile in QUANTILES:
+            summary["latency_seconds"]["p" + str(int(quantile * 100))] = round(get_quantile(latencies, quantile), 6)
+        return summary
+
+    def get_snapshot(self):
+        # Per (service, operation) totals across accounts and regions, followed by every tagged series
+        with self.lock:
+            items = sorted(self.series.items())
+            operations = dict()
+            for (service, operation, account, region), series in items:
+                total = operations.setdefault((service, operation), {"calls": 0, "pages": 0, "errors": 0,
+                                                                     "retries": 0, "response_bytes": 0,
+                                                                     "latencies": array("d")})
+                for key in ("calls", "pages", "errors", "retries", "response_bytes"):
+                    total[key] += series[key]
+                total["latencies"].extend(series["latencies"])
+            return {
+                "operations": [dict(service=service, operation=operation, **self.summarize(total))
+                               for (service, operation), total in sorted(operations.items())],
+                "series": [dict(service=service, operation=operation, account=account, region=region,
+                                **self.summarize(series))
+                           for (service, operation, account, region), series in items]
+            }
+
+    def write_json(self, path):
+        with open(path, "w") as fp:
+            json.dump(self.get_snapshot(), fp, indent=2)
+
+    def write_prometheus(self, path):
+        # Prometheus textfile collector format
+        snapshot = self.get_snapshot()
+        counters = [("calls", "API requests sent"), ("pages", "Successful API responses"),
+                    ("errors", "API requests that failed"), ("retries", "API requests retried after an error"),
+                    ("response_bytes", "Bytes received in API responses")]
+        lines = []
+        for key, description in counters:
+            name = METRIC_PREFIX + "_" + key + "_total"
+            lines += ["# HELP " + name + " " + description, "# TYPE " + name + " counter"]
+            lines += [name + self.get_labels(series) + " " + str(series[key]) for series in snapshot["series"]]
+        name = METRIC_PREFIX + "_latency_seconds"
+        lines += ["# HELP " + name + " API request latency", "# TYPE " + name + " summary"]
+        for series in snapshot["series"]:
+            latency = series["latency_seconds"]
+            for quantile in QUANTILES:
+                lines.append(name + self.get_labels(series, quantile=str(quantile)) + " " +
+                             str(latency["p" + str(int(quantile * 100))]))
+            lines.append(name + "_sum" + self.get_labels(series) + " " + str(latency["sum"]))
+            lines.append(name + "_count" + self.get_labels(series) + " " + str(latency["count"]))
+        with open(path, "w") as fp:
+            fp.write("\n".join(lines) + "\n")
+
+    @staticmethod
+    def get_labels(series, **extra_labels):
+        labels = [("service", series["service"]), ("operation", series["operation"]), ("account", series["account"]),
+                  ("region", series["region"])] + sorted(extra_labels.items())
+        return "{" + ",".join(key + '="' + value + '"' for key, value in labels) + "}"
@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+import time
+
+DEFAULT_ORG_CACHE_PATH = ".orgwide_instances_org_cache.json"
+
+
+class OrgMetadataCache:
+    # Memoizes organization metadata (caller account, delegated admin status, roots, OU listings, account
+    # lists) for the process. With a TTL and a path, entries are also kept on disk so later runs and the
+    # other scripts skip the control plane calls while the entries are fresh. The disk cache is only used
+    # for the same credentials scope it was written with.
+    def __init__(self, path=None, ttl=0, scope=""):
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.configure(path, ttl, scope)
+
+    def configure(self, path=None, ttl=0, scope=""):
+        # Entries loaded from disk are added to the ones already cached in memory
+        with self.lock:
+            self.path = path
+            self.ttl = ttl
+            self.scope = scope
+            if self.path and self.ttl > 0:
+                self.entries.update(self.load())
+
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                cache = json.load(fp)
+        except (OSError, ValueError):
+            return dict()
+        if cache.get("scope") != self.scope:
+            return dict()
+        return {key: entry for key, entry in cache.get("entries", {}).items() if self.is_fresh(entry)}
+
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as fp:
+            json.dump({"scope": self.scope, "entries": self.entries}, fp)
+        os.replace(temporary_path, self.path)
+
+    def is_fresh(self, entry):
+        return self.ttl <= 0 or time.time() - entry["time"] < self.ttl
+
+    def get(self, key, loader):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.is_fresh(entry):
+                return entry["value"]
+        value = loader()
+        with self.lock:
+            self.entries[key] = {"value": value, "time": time.time()}
+            if self.path and self.ttl > 0:
+                self.save()
+        return value
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+            if self.path and self.ttl > 0:
+                self.save()
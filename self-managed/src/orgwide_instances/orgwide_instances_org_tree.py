@@ -0,0 +1,98 @@
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_ORG_TREE_WORKERS = 4
+DEFAULT_ORG_TREE_PATH = "org_tree.json"
+DEFAULT_ORG_TREE_TTL = 86400
+# Accounts that can no longer be crawled; role assumption fails in them
+SUSPENDED_ACCOUNT_STATUSES = ("SUSPENDED", "PENDING_CLOSURE")
+
+
+def unique(items):
+    # Removes duplicates and keeps the first occurrence of each item in place
+    return list(dict.fromkeys(items))
+
+
+def get_account_summary(account):
+    return {"Id": account["Id"], "Name": account.get("Name", ""), "Status": account.get("Status", "")}
+
+
+class OrgTreeWalker:
+    # Walks the OU tree below a list of parents (roots or OUs) breadth first. The child OUs and accounts of
+    # every parent of a level are listed concurrently, each listing following its own pagination, before the
+    # next level starts. call(function, **kwargs) makes a paced Organizations API call.
+    def __init__(self, org_client, call, max_workers=DEFAULT_ORG_TREE_WORKERS):
+        self.org_client = org_client
+        self.call = call
+        self.max_workers = max(1, max_workers)
+
+    def list_pages(self, function, key, **kwargs):
+        response = self.call(function, **kwargs)
+        items = list(response[key])
+        while "NextToken" in response:
+            response = self.call(function, NextToken=response["NextToken"], **kwargs)
+            items += response[key]
+        return items
+
+    def list_children(self, parent_id):
+        organizational_units = self.list_pages(self.org_client.list_organizational_units_for_parent,
+                                               "OrganizationalUnits", ParentId=parent_id)
+        accounts = self.list_pages(self.org_client.list_accounts_for_parent, "Accounts", ParentId=parent_id)
+        return {"organizational_units": [ou["Id"] for ou in organizational_units],
+                "accounts": [get_account_summary(account) for account in accounts]}
+
+    def walk(self, parent_ids):
+        # Returns the snapshot {"parents": [...], "children": {parent_id: {"organizational_units": [...],
+        # "accounts": [...]}}} of every OU below parent_ids, which is plain JSON so it can be cached
+        children = dict()
+        level = unique(parent_ids)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while level:
+                for parent_id, listing in zip(level, pool.map(self.list_children, level)):
+                    children[parent_id] = listing
+                level = unique(ou_id for parent_id in level for ou_id in children[parent_id]["organizational_units"]
+                               if ou_id not in children)
+        return {"parents": unique(parent_ids), "children": children}
+
+
+def get_tree_accounts(tree, parent_ids=None):
+    # Accounts below parent_ids in breadth first order: the accounts of each level come before those of
+    # the next one and keep the order Organizations listed them in. Accounts are reported once.
+    accounts = dict()
+    visited = set()
+    queue = deque(tree["parents"] if parent_ids is None else parent_ids)
+    while queue:
+        parent_id = queue.popleft()
+        if parent_id in visited or parent_id not in tree["children"]:
+            continue
+        visited.add(parent_id)
+        listing = tree["children"][parent_id]
+        for account in listing["accounts"]:
+            accounts.setdefault(account["Id"], account)
+        queue.extend(listing["organizational_units"])
+    return list(accounts.values())
+
+
+def filter_suspended_accounts(accounts):
+    return [account for account in accounts if account.get("Status") not in SUSPENDED_ACCOUNT_STATUSES]
+
+
+def load_tree_snapshot(path, parent_ids, ttl):
+    # The tree written by an earlier run below the same parents, or None when it is missing or older than ttl
+    if ttl <= 0:
+        return None
+    try:
+        with open(path) as fp:
+            snapshot = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get("parents") != unique(parent_ids) or time.time() - snapshot.get("time", 0) >= ttl:
+        return None
+    return {"parents": snapshot["parents"], "children": snapshot["children"]}
+
+
+def write_tree_snapshot(tree, path):
+    with open(path, "w") as fp:
+        json.dump(dict(tree, time=time.time()), fp, indent=2)
@@ -0,0 +1,39 @@
+import importlib
+import time
+from orgwide_instances_utils import get_inputs, configure_org_cache
+
+CREATE_ROLES_STAGE = "orgwide_instances_create_roles"
+DELETE_ROLES_STAGE = "orgwide_instances_delete_roles"
+AGGREGATOR_STAGE = "orgwide_instances_data_aggregator"
+
+
+class PipelineContext:
+    # State shared by the stages of one run: the inputs are read once, the organization metadata cache and
+    # the management account clients (see get_management_client) live for the whole process, and the member
+    # account client cache built by the first stage that needs it is handed to the next ones
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.org_cache = configure_org_cache(inputs)
+        self.client_cache = None
+        self.stage_seconds = dict()
+
+    @classmethod
+    def from_inputs_file(cls):
+        return cls(get_inputs())
+
+
+def get_context(context=None):
+    # Stages started on their own build a context from orgwide_instances_inputs.json
+    if context is None:
+        return PipelineContext.from_inputs_file()
+    return context
+
+
+def run_stage(context, stage):
+    # Stage modules are imported on first use, so a run only loads the stages it executes
+    start = time.perf_counter()
+    try:
+        module = importlib.import_module(stage)
+        return module.main([], context)
+    finally:
+        context.stage_seconds[stage] = time.perf_counter() - start
@@ -0,0 +1,17 @@
+from collections import namedtuple
+from orgwide_instances_utils import LICENSE_INCLUDED, MARKETPLACE, BYOL, categorized_fields
+
+# One fixed column layout per category. Records are plain tuples in CSV column order, so they carry no
+# per-instance dict and are written to the CSVs as they are.
+record_types = {
+    LICENSE_INCLUDED: namedtuple("LicenseIncludedRecord", categorized_fields[LICENSE_INCLUDED]),
+    MARKETPLACE: namedtuple("MarketplaceRecord", categorized_fields[MARKETPLACE]),
+    BYOL: namedtuple("ByolRecord", categorized_fields[BYOL])
+}
+
+
+def build_record(instance_type, ec2_instance, values):
+    # values holds the columns that do not come straight from the instance, e.g. AccountId and Region
+    record_type = record_types[instance_type]
+    return record_type._make([values[field] if field in values else ec2_instance.get(field)
+                              for field in record_type._fields])
@@ -0,0 +1,65 @@
+import json
+import os
+import threading
+import time
+
+DEFAULT_REGION_PLAN_PATH = "region_plan.json"
+DEFAULT_REGION_CACHE_TTL = 86400
+
+
+class RegionPlanner:
+    # Caches the regions enabled in each member account between runs. Accounts that opted in to the same
+    # regions share one "opt-in class", so the file holds every distinct region list once and each account
+    # points at its class. Also counts the DescribeRegions calls and region scans a run avoided.
+    def __init__(self, path=DEFAULT_REGION_PLAN_PATH, ttl=DEFAULT_REGION_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.classes, self.accounts = self.load()
+        self.stats = {"cached_region_lists": 0, "described_region_lists": 0, "probed_regions": 0,
+                      "scans_avoided": 0}
+
+    def load(self):
+        if not self.path or self.ttl <= 0:
+            return [], dict()
+        try:
+            with open(self.path) as fp:
+                plan = json.load(fp)
+        except (OSError, ValueError):
+            return [], dict()
+        return plan["classes"], plan["accounts"]
+
+    def save(self):
+        if not self.path or self.ttl <= 0:
+            return
+        with self.lock:
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as fp:
+                json.dump({"classes": self.classes, "accounts": self.accounts}, fp, sort_keys=True)
+            os.replace(temporary_path, self.path)
+
+    def get_regions(self, account, loader):
+        # Region list of the account; loader() describes the regions when the cached list is missing or stale
+        with self.lock:
+            entry = self.accounts.get(account)
+            if entry is not None and time.time() - entry["time"] < self.ttl:
+                self.stats["cached_region_lists"] += 1
+                return list(self.classes[entry["class"]])
+        regions = loader()
+        with self.lock:
+            self.stats["described_region_lists"] += 1
+            if regions in self.classes:
+                class_index = self.classes.index(regions)
+            else:
+                class_index = len(self.classes)
+                self.classes.append(regions)
+            self.accounts[account] = {"class": class_index, "time": time.time()}
+        return regions
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, opt_in_classes=len(self.classes))
@@ -0,0 +1,137 @@
+import argparse
+import os
+import time
+from orgwide_instances_store import InventoryStore, DEFAULT_STORE_PATH
+from orgwide_instances_columnar import CSV, PARQUET, ARROW, COLUMNAR_EXTENSIONS, check_output_formats
+
+# numpy and pandas are only needed for the rollups and only imported by import_pandas, so runs without rollups
+# never load them
+numpy = None
+pandas = None
+
+# Dimensions a rollup can group by, with the store column each one is read from and its file name part
+DIMENSIONS = {
+    "AccountId": ("AccountId", "account"),
+    "Region": ("Region", "region"),
+    "Category": ("category", "category"),
+    "PlatformDetails": ("PlatformDetails", "platform"),
+    "InstanceType": ("InstanceType", "instance_type"),
+    "InstanceStateName": ("InstanceStateName", "state")
+}
+DEFAULT_ROLLUPS = [["Category"], ["AccountId", "Category"], ["Region", "Category"], ["Category", "PlatformDetails"],
+                   ["Category", "InstanceType"], ["AccountId", "Region", "Category", "PlatformDetails", "InstanceType"]]
+
+
+def import_pandas():
+    # Returns whether numpy and pandas are installed
+    global numpy, pandas
+    try:
+        import numpy
+        import pandas
+    except ImportError:
+        return False
+    return True
+
+
+def check_rollups(rollups):
+    # Returns an error message for unknown dimensions or a missing pandas, or None
+    unknown = sorted({dimension for dimensions in rollups for dimension in dimensions} - set(DIMENSIONS))
+    if unknown:
+        return "Unknown rollup dimensions " + ", ".join(unknown) + "; use " + ", ".join(DIMENSIONS)
+    if rollups and not import_pandas():
+        return "pandas is required for rollups; install it with: pip install pandas"
+    return None
+
+
+def get_rollup_name(dimensions):
+    return "rollup_" + "_".join(DIMENSIONS[dimension][1] for dimension in dimensions)
+
+
+def load_instances(store, run_id, dimensions):
+    # One row per instance of the run: the dimensions as categoricals and VCpus as a float, NaN when unknown.
+    # The store is read in batches; each batch's values are factorized and mapped onto codes shared by the
+    # whole run, so every dimension costs one small integer per instance.
+    import_pandas()
+    dictionaries = {dimension: dict() for dimension in dimensions}
+    codes = {dimension: [] for dimension in dimensions}
+    vcpus = []
+    columns = [DIMENSIONS[dimension][0] for dimension in dimensions] + ["VCpus"]
+    for rows in store.iterate_columns(run_id, columns):
+        values = list(zip(*rows))
+        for dimension, column in zip(dimensions, values):
+            batch_codes, uniques = pandas.factorize(numpy.array(column, dtype=object))
+            dictionary = dictionaries[dimension]
+            # Missing values are coded -1, which picks the trailing -1
+            mapping = numpy.array([dictionary.setdefault(value, len(dictionary)) for value in uniques] + [-1],
+                                  dtype=numpy.int32)
+            codes[dimension].append(mapping[batch_codes])
+        vcpus.append(pandas.to_numeric(pandas.Series(values[-1], dtype=object), errors="coerce").to_numpy(float))
+
+    frame = dict()
+    for dimension in dimensions:
+        categorical = pandas.Categorical.from_codes(numpy.concatenate(codes[dimension] or [numpy.empty(0, int)]),
+                                                    categories=list(dictionaries[dimension]))
+        frame[dimension] = categorical.reorder_categories(sorted(dictionaries[dimension]))
+    frame["VCpus"] = numpy.concatenate(vcpus or [numpy.empty(0)])
+    return pandas.DataFrame(frame)
+
+
+def build_rollup(instances, dimensions):
+    # Instance counts and vCPU totals per combination of the dimensions that has instances, sorted by them
+    rollup = instances.groupby(dimensions, observed=True, sort=True, dropna=False).agg(
+        Instances=("VCpus", "size"), VCpus=("VCpus", "sum"), InstancesWithVCpus=("VCpus", "count")).reset_index()
+    rollup["VCpus"] = rollup["VCpus"].astype("int64")
+    rollup["InstancesWithoutVCpus"] = rollup["Instances"] - rollup.pop("InstancesWithVCpus")
+    return rollup
+
+
+def write_rollup(rollup, name, output_formats=(CSV,)):
+    if CSV in output_formats:
+        rollup.to_csv(name + ".csv", index=False)
+    if PARQUET in output_formats:
+        rollup.to_parquet(name + COLUMNAR_EXTENSIONS[PARQUET], index=False, compression="zstd")
+    if ARROW in output_formats:
+        rollup.to_feather(name + COLUMNAR_EXTENSIONS[ARROW], compression="zstd")
+
+
+def write_rollups(store, run_id, rollups=DEFAULT_ROLLUPS, output_formats=(CSV,)):
+    # Loads the dimensions used by any rollup once and writes one file per rollup and output format.
+    # Returns the number of instances.
+    dimensions = list(dict.fromkeys(dimension for rollup_dimensions in rollups for dimension in rollup_dimensions))
+    instances = load_instances(store, run_id, dimensions)
+    for rollup_dimensions in rollups:
+        write_rollup(build_rollup(instances, rollup_dimensions), get_rollup_name(rollup_dimensions),
+                     output_formats)
+    return len(instances)
+
+
+def main(command_line=None):
+    parser = argparse.ArgumentParser(description="Writes instance counts and vCPU totals of a stored run grouped "
+                                                 "by account, region, category, platform and instance type")
+    parser.add_argument("--store", default=DEFAULT_STORE_PATH)
+    parser.add_argument("--run-id", type=int, help="Defaults to the latest complete run")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--format", dest="output_formats", action="append", choices=[CSV, PARQUET, ARROW],
+                        help="Output format, may be repeated; defaults to csv")
+    args = parser.parse_args(command_line)
+
+    output_formats = args.output_formats or [CSV]
+    error = check_rollups(DEFAULT_ROLLUPS) or check_output_formats(output_formats)
+    if error is not None:
+        print(error)
+        return
+    with InventoryStore(os.path.abspath(args.store)) as store:
+        run_id = args.run_id if args.run_id is not None else store.get_latest_run_id()
+        if run_id is None:
+            print("No complete run in " + args.store)
+            return
+        os.makedirs(args.output_dir, exist_ok=True)
+        os.chdir(args.output_dir)
+        start = time.perf_counter()
+        instances = write_rollups(store, run_id, output_formats=output_formats)
+    print("Rolled up " + str(instances) + " instances of run " + str(run_id) + " in " +
+          str(round(time.perf_counter() - start, 1)) + "s to " + os.getcwd())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import argparse
+import csv
+import heapq
+import math
+import random
+import statistics
+from collections import defaultdict, Counter
+from orgwide_instances_utils import TOTAL, LICENSE_INCLUDED, MARKETPLACE, BYOL, BYOL_CORES, STS_ERRORS, EC2_ERRORS
+from orgwide_instances_org_tree import get_tree_accounts
+
+OU_STRATA = "ou"
+SIZE_STRATA = "size"
+# Stratum of the strata too small to get MIN_STRATUM_SAMPLE accounts of a proportional sample
+MERGED_STRATUM = "merged"
+DEFAULT_SAMPLE_SEED = 0
+DEFAULT_CONFIDENCE = 0.95
+# Accounts with a history are split into this many strata of equal account counts by instance count
+SIZE_STRATA_COUNT = 4
+# Accounts sampled at least from every stratum that has them, so each stratum has a variance, as long as the
+# sample size allows
+MIN_STRATUM_SAMPLE = 2
+ESTIMATE_FIELDS = ["Metric", "Estimate", "Lower", "Upper", "StandardError", "Share", "SampledAccounts", "Accounts"]
+ESTIMATED_METRICS = [TOTAL, LICENSE_INCLUDED, MARKETPLACE, BYOL, BYOL_CORES]
+CATEGORIES = [LICENSE_INCLUDED, MARKETPLACE, BYOL]
+
+
+def parse_fraction(value):
+    try:
+        fraction = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a fraction, e.g. 0.05")
+    if not 0 < fraction <= 1:
+        raise argparse.ArgumentTypeError("the fraction needs 0 < fraction <= 1")
+    return fraction
+
+
+def get_ou_strata(accounts, tree):
+    # Each account's stratum is the OU of "ou_ids" it was found below, so the accounts of nested OUs share the
+    # stratum of their top-level OU; accounts given in "accounts" share one stratum
+    branches = dict()
+    for parent_id in tree["parents"]:
+        for account in get_tree_accounts(tree, [parent_id]):
+            branches.setdefault(account["Id"], parent_id)
+    return {account: branches.get(account, "accounts") for account in accounts}
+
+
+def get_size_strata(accounts, account_instances, strata_count=SIZE_STRATA_COUNT):
+    # Accounts crawled before are split by their instance count in the previous runs; the others are a
+    # stratum of their own
+    known = sorted((account_instances[account], account) for account in accounts if account in account_instances)
+    strata = {account: "size-unknown" for account in accounts if account not in account_instances}
+    for index, (_, account) in enumerate(known):
+        strata[account] = "size-" + str(index * strata_count // len(known) + 1)
+    return strata
+
+
+def merge_small_strata(strata, sample_size):
+    # Strata whose proportional share of sample_size is below MIN_STRATUM_SAMPLE accounts are merged into one,
+    # so that many small OUs neither take the whole sample nor go unsampled
+    counts = Counter(strata.values())
+    small = {stratum for stratum, count in counts.items() if sample_size * count / len(strata) < MIN_STRATUM_SAMPLE}
+    if len(small) < 2:
+        return strata
+    return {account: MERGED_STRATUM if stratum in small else stratum for account, stratum in strata.items()}
+
+
+def get_budget_sample_size(accounts, account_seconds, budget, max_workers):
+    # How many accounts max_workers workers crawl in budget seconds, at the mean crawl time of the accounts
+    # with a history. None when no account has one.
+    seconds = [account_seconds[account] for account in accounts if account in account_seconds]
+    if not seconds:
+        return None
+    mean_seconds = statistics.fmean(seconds) or 1e-3
+    return max(1, min(len(accounts), int(budget * max_workers / mean_seconds)))
+
+
+def get_stratum_weights(members, account_instances):
+    # Neyman allocation: a stratum's share of the sample grows with its account count and with the spread of
+    # its accounts' instance counts in the previous runs. Strata without any history use the spread of all
+    # the accounts that have one; without any history at all, the allocation is proportional.
+    known = [account_instances[account] for stratum_accounts in members.values() for account in stratum_accounts
+             if account in account_instances]
+    pooled_deviation = statistics.pstdev(known) if len(known) > 1 else 0
+    weights = dict()
+    for stratum, stratum_accounts in members.items():
+        sizes = [account_instances[account] for account in stratum_accounts if account in account_instances]
+        deviation = statistics.pstdev(sizes) if len(sizes) > 1 else pooled_deviation
+        weights[stratum] = len(stratum_accounts) * deviation
+    if not any(weights.values()):
+        return {stratum: len(stratum_accounts) for stratum, stratum_accounts in members.items()}
+    return weights
+
+
+def allocate_sample(members, weights, sample_size):
+    # Accounts to sample from each stratum, adding up to sample_size, or to every account when there are fewer.
+    # Strata first get MIN_STRATUM_SAMPLE accounts each, heaviest first, while the sample size lasts. Every
+    # further account goes to the stratum whose share of the variance it reduces most, weight ** 2 / (n * (n
+    # + 1)) for a stratum already allocated n accounts, which converges on the Neyman allocation.
+    order = sorted(members, key=lambda stratum: (-weights[stratum], stratum))
+    remaining = min(sample_size, sum(len(stratum_accounts) for stratum_accounts in members.values()))
+    allocation = dict()
+    for stratum in order:
+        allocation[stratum] = min(MIN_STRATUM_SAMPLE, len(members[stratum]), remaining)
+        remaining -= allocation[stratum]
+
+    def get_priority(stratum):
+        return -weights[stratum] ** 2 / (allocation[stratum] * (allocation[stratum] + 1)), stratum
+
+    candidates = [get_priority(stratum) for stratum in order if 0 < allocation[stratum] < len(members[stratum])]
+    heapq.heapify(candidates)
+    while remaining and candidates:
+        _, stratum = heapq.heappop(candidates)
+        allocation[stratum] += 1
+        remaining -= 1
+        if allocation[stratum] < len(members[stratum]):
+            heapq.heappush(candidates, get_priority(stratum))
+    return allocation
+
+
+def select_sample(accounts, strata, sample_size, seed=DEFAULT_SAMPLE_SEED, account_instances=None):
+    # Stratified random sample of sample_size accounts allocated to the strata by allocate_sample, see
+    # get_stratum_weights. Accounts are drawn with a generator seeded with seed, so the same seed, accounts,
+    # strata and history give the same sample. The sample keeps the order of accounts.
+    members = defaultdict(list)
+    for account in accounts:
+        members[strata[account]].append(account)
+    allocation = allocate_sample(members, get_stratum_weights(members, account_instances or dict()), sample_size)
+    rnd = random.Random(seed)
+    sampled = set()
+    for stratum in sorted(members):
+        sampled.update(rnd.sample(sorted(members[stratum]), allocation[stratum]))
+    return [account for account in accounts if account in sampled]
+
+
+def has_complete_inventory(summary, account):
+    return summary[account][STS_ERRORS] == 0 and summary[account][EC2_ERRORS] == 0
+
+
+def estimate_totals(accounts, strata, sampled_accounts, summary, confidence=DEFAULT_CONFIDENCE):
+    # Stratified expansion estimates of the organization totals: each stratum's total is its account count
+    # times the mean of its sampled accounts, with the finite population corrected variance of that mean.
+    # Sampled accounts with role or EC2 errors are left out. A stratum none of whose sampled accounts
+    # succeeded is estimated from all of them, without the correction.
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    population = defaultdict(int)
+    for account in accounts:
+        population[strata[account]] += 1
+    responding = defaultdict(list)
+    for account in sampled_accounts:
+        if has_complete_inventory(summary, account):
+            responding[strata[account]].append(account)
+    pooled = [account for stratum_accounts in responding.values() for account in stratum_accounts]
+
+    estimates = dict()
+    for metric in ESTIMATED_METRICS:
+        estimate = variance = 0
+        for stratum, stratum_size in population.items():
+            stratum_accounts = responding.get(stratum) or pooled
+            if not stratum_accounts:
+                continue
+            values = [summary[account][metric] for account in stratum_accounts]
+            sampled = len(values)
+            correction = max(0, 1 - sampled / stratum_size) if stratum in responding else 1
+            estimate += stratum_size * statistics.fmean(values)
+            if sampled > 1:
+                variance += stratum_size ** 2 * correction * statistics.variance(values) / sampled
+        observed = sum(summary[account][metric] for account in pooled)
+        standard_error = math.sqrt(variance)
+        estimates[metric] = {"Estimate": estimate, "StandardError": standard_error,
+                             "Lower": max(observed, estimate - z * standard_error),
+                             "Upper": estimate + z * standard_error}
+    return estimates, len(pooled)
+
+
+def write_summary_estimate(estimates, sampled_accounts, accounts, path="summary_estimate.csv"):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(ESTIMATE_FIELDS)
+        for metric, estimate in estimates.items():
+            total = estimates[TOTAL]["Estimate"]
+            share = round(estimate["Estimate"] / total, 4) if metric in CATEGORIES and total else ""
+            writer.writerow([metric, round(estimate["Estimate"]), math.floor(estimate["Lower"]),
+                             math.ceil(estimate["Upper"]), round(estimate["StandardError"], 1), share,
+                             sampled_accounts, accounts])
@@ -0,0 +1,110 @@
+import json
+import math
+import os
+import threading
+
+DEFAULT_HISTORY_PATH = "unit_history.json"
+# Weight of the latest run in the smoothed duration and instance count of a unit
+HISTORY_WEIGHT = 0.5
+# Regions that were empty in the previous run are crawled this many at a time by one worker
+EMPTY_REGION_BATCH_SIZE = 8
+
+
+class UnitHistory:
+    # Duration and instance count of every (account, region) unit in previous runs, smoothed exponentially
+    # and kept in a JSON file between runs, with the instance count of the latest run as last_instances
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        self.path = path
+        self.units = self.load()
+        self.observed = dict()
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not self.path:
+            return dict()
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return dict()
+
+    @staticmethod
+    def get_key(account, region):
+        return account + ":" + region
+
+    def get(self, account, region):
+        return self.units.get(self.get_key(account, region))
+
+    def is_empty(self, account, region):
+        # Empty in the latest run that crawled the unit; histories written before last_instances was kept fall
+        # back to the smoothed count
+        entry = self.get(account, region)
+        return entry is not None and entry.get("last_instances", entry["instances"]) == 0
+
+    def estimate(self, account, region):
+        # Predicted seconds; units that were never crawled are assumed to be the heaviest
+        entry = self.get(account, region)
+        return math.inf if entry is None else entry["seconds"]
+
+    def get_account_totals(self):
+        # Smoothed seconds and instances of every account crawled before, summed over its regions
+        totals = dict()
+        for key, entry in self.units.items():
+            account_totals = totals.setdefault(key.split(":", 1)[0], {"seconds": 0, "instances": 0})
+            account_totals["seconds"] += entry["seconds"]
+            account_totals["instances"] += entry["instances"]
+        return totals
+
+    def record(self, account, region, seconds, instances):
+        with self.lock:
+            self.observed[self.get_key(account, region)] = {"seconds": seconds, "instances": instances}
+
+    def save(self):
+        with self.lock:
+            for key, observed in self.observed.items():
+                previous = self.units.get(key)
+                if previous is None:
+                    self.units[key] = dict(observed)
+                else:
+                    self.units[key] = {name: round(HISTORY_WEIGHT * observed[name] +
+                                                   (1 - HISTORY_WEIGHT) * previous[name], 4)
+                                       for name in ("seconds", "instances")}
+                self.units[key]["last_instances"] = observed["instances"]
+            self.observed.clear()
+            if not self.path:
+                return
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as fp:
+                json.dump(self.units, fp, sort_keys=True)
+            os.replace(temporary_path, self.path)
+
+
+def plan_tasks(units, history, batch_size=EMPTY_REGION_BATCH_SIZE):
+    # Turns (account, region, classifier) units into (account, [(unit index, region), ...], classifier) tasks.
+    # Regions of an account that were empty in the previous run share a task, up to batch_size of them; every
+    # other unit is a task of its own. Returns the tasks, their ranks and their predicted seconds. Ranks put
+    # the longest predicted duration first (LPT), units without history before all others, ties in unit order.
+    tasks = []
+    open_batches = dict()
+    for index, (account, region, classifier) in enumerate(units):
+        if not history.is_empty(account, region):
+            tasks.append((account, [(index, region)], classifier))
+            continue
+        batch = open_batches.get(account)
+        if batch is None or len(batch[1]) >= batch_size:
+            batch = open_batches[account] = (account, [], classifier)
+            tasks.append(batch)
+        batch[1].append((index, region))
+
+    estimates = [sum(history.estimate(account, region) for _, region in regions) for account, regions, _ in tasks]
+    ranks = [0] * len(tasks)
+    for rank, task_index in enumerate(sorted(range(len(tasks)), key=lambda index: (-estimates[index], index))):
+        ranks[task_index] = rank
+    return tasks, ranks, estimates
+
+
+def get_ideal_seconds(estimates, max_workers):
+    # Lower bound on the crawl time with max_workers workers, when every task has a history
+    if not estimates or math.inf in estimates:
+        return None
+    return max(max(estimates), sum(estimates) / max_workers)
@@ -0,0 +1,121 @@
+import argparse
+import csv
+import hashlib
+import heapq
+import json
+import os
+from orgwide_instances_utils import LICENSE_INCLUDED, MARKETPLACE, BYOL, categorized_fields
+
+SHARD_MANIFEST = "shard.json"
+CATEGORY_CSVS = [LICENSE_INCLUDED, BYOL, MARKETPLACE]
+
+
+def parse_shard(value):
+    # "K/N" with 1 <= K <= N, e.g. 2/4 for the second of four shards
+    try:
+        shard, shards = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected K/N, e.g. 2/4")
+    if not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError("shard K/N needs 1 <= K <= N")
+    return shard, shards
+
+
+def get_shard(account, shards):
+    # Stable across hosts and Python versions, unlike hash()
+    return int(hashlib.sha256(account.encode()).hexdigest(), 16) % shards + 1
+
+
+def select_shard_accounts(all_accounts, shard, shards):
+    return [account for account in all_accounts if get_shard(account, shards) == shard]
+
+
+def write_shard_manifest(shard, shards, all_accounts, shard_accounts, summary, error_messages,
+                         misconfigured_accounts, path=SHARD_MANIFEST):
+    # Everything the merge needs besides the category CSVs; all_accounts is the discovery order of the whole
+    # organization, which the merged outputs follow
+    manifest = {
+        "shard": shard,
+        "shards": shards,
+        "accounts": all_accounts,
+        "summary": {account: summary[account] for account in shard_accounts},
+        "error_messages": {account: error_messages[account] for account in shard_accounts},
+        "misconfigured_accounts": sorted(misconfigured_accounts)
+    }
+    with open(path, "w") as fp:
+        json.dump(manifest, fp, indent=2)
+
+
+def load_shard_manifests(shard_dirs):
+    manifests = []
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, SHARD_MANIFEST)) as fp:
+            manifests.append(json.load(fp))
+    shards = manifests[0]["shards"]
+    found = sorted(manifest["shard"] for manifest in manifests)
+    if any(manifest["shards"] != shards for manifest in manifests) or found != list(range(1, shards + 1)):
+        raise ValueError("Expected shards 1 to " + str(shards) + " once each, found " + str(found))
+    if any(manifest["accounts"] != manifests[0]["accounts"] for manifest in manifests):
+        raise ValueError("Shards were run against different account lists; run them with the same inputs")
+    return manifests
+
+
+def read_category_rows(path, category):
+    with open(path, newline='') as fp:
+        reader = csv.reader(fp)
+        if next(reader) != categorized_fields[category]:
+            raise ValueError(path + " does not have the " + category + " columns")
+        yield from reader
+
+
+def merge_category_csv(shard_dirs, category, account_order):
+    # Each shard wrote its accounts in the global account order, so the shard files are merged like sorted
+    # runs: rows are streamed, and the rows of one account keep the order their shard wrote them in
+    readers = [read_category_rows(os.path.join(shard_dir, category + ".csv"), category) for shard_dir in shard_dirs]
+    with open(category + ".csv", 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(categorized_fields[category])
+        writer.writerows(heapq.merge(*readers, key=lambda row: account_order[row[0]]))
+
+
+def merge_shards(shard_dirs):
+    import orgwide_instances_data_aggregator as aggregator
+
+    manifests = load_shard_manifests(shard_dirs)
+    all_accounts = manifests[0]["accounts"]
+    account_order = {account: index for index, account in enumerate(all_accounts)}
+
+    for category in CATEGORY_CSVS:
+        merge_category_csv(shard_dirs, category, account_order)
+
+    # The summary and report are written by the aggregator's own functions from the shards' counts
+    for account in all_accounts:
+        for manifest in manifests:
+            if account in manifest["summary"]:
+                aggregator.summary[account] = manifest["summary"][account]
+                aggregator.error_messages[account] = manifest["error_messages"][account]
+    for manifest in manifests:
+        aggregator.misconfigured_accounts.update(manifest["misconfigured_accounts"])
+    missing = [account for account in all_accounts if account not in aggregator.summary]
+    if missing:
+        raise ValueError("No shard crawled accounts " + ", ".join(missing))
+    aggregator.create_summary(all_accounts)
+    aggregator.write_report()
+
+
+def main(command_line=None):
+    parser = argparse.ArgumentParser(description="Merges the outputs of aggregator runs started with --shard K/N "
+                                                 "into the outputs of a single run")
+    parser.add_argument("shard_dirs", nargs="+", help="Output directory of every shard")
+    parser.add_argument("--output-dir", default=".", help="Where the merged CSVs, summary.csv and report.txt go")
+    args = parser.parse_args(command_line)
+
+    shard_dirs = [os.path.abspath(shard_dir) for shard_dir in args.shard_dirs]
+    os.makedirs(args.output_dir, exist_ok=True)
+    os.chdir(args.output_dir)
+    merge_shards(shard_dirs)
+    print("Merged " + str(len(shard_dirs)) + " shards into " + os.getcwd())
+
+
+if __name__ == '__main__':
+    main()
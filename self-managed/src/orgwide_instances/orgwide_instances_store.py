@@ -0,0 +1,250 @@
+import argparse
+import os
+import sqlite3
+import time
+from orgwide_instances_utils import LICENSE_INCLUDED, MARKETPLACE, BYOL, TOTAL, TOTAL_ERRORS, STS_ERRORS, \
+    EC2_ERRORS, SSM_ERRORS, BYOL_CORES, INTEGER_FIELDS, categorized_fields
+from orgwide_instances_writers import CategoryCsvWriter
+
+DEFAULT_STORE_PATH = "inventory.db"
+CATEGORIES = [LICENSE_INCLUDED, BYOL, MARKETPLACE]
+# Every CSV column of every category; a category leaves the columns it does not have empty
+INVENTORY_FIELDS = list(dict.fromkeys(field for category in CATEGORIES for field in categorized_fields[category]))
+SUMMARY_FIELDS = [TOTAL, LICENSE_INCLUDED, MARKETPLACE, BYOL, TOTAL_ERRORS, STS_ERRORS, EC2_ERRORS, SSM_ERRORS,
+                  BYOL_CORES]
+EXPORT_BATCH_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started TEXT NOT NULL,
+    finished TEXT,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS instances (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    seq INTEGER NOT NULL,
+    category TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS account_summaries (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    AccountId TEXT NOT NULL,
+    {summary_columns},
+    PRIMARY KEY (run_id, AccountId)
+);
+CREATE TABLE IF NOT EXISTS errors (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    AccountId TEXT NOT NULL,
+    error_type TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE VIEW IF NOT EXISTS latest_run AS
+    SELECT MAX(run_id) AS run_id FROM runs WHERE status = 'complete';
+CREATE VIEW IF NOT EXISTS latest_instances AS
+    SELECT * FROM instances WHERE run_id = (SELECT run_id FROM latest_run);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS instances_by_category ON instances (run_id, category, seq);
+CREATE INDEX IF NOT EXISTS instances_by_account ON instances (run_id, AccountId);
+CREATE INDEX IF NOT EXISTS instances_by_region ON instances (run_id, Region);
+CREATE INDEX IF NOT EXISTS instances_by_platform ON instances (run_id, PlatformDetails);
+CREATE INDEX IF NOT EXISTS instances_by_instance_id ON instances (InstanceId, run_id);
+CREATE INDEX IF NOT EXISTS instances_by_run_instance_id ON instances (run_id, InstanceId);
+CREATE INDEX IF NOT EXISTS errors_by_account ON errors (run_id, AccountId);
+"""
+
+
+def fetch_batches(cursor):
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            return
+        yield rows
+
+
+def get_timestamp():
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+class InventoryStore:
+    # SQLite store of every run's instances, account summaries and errors, keyed by run ID. Each (account,
+    # region) unit is written in its own transaction as soon as it finishes, so the rows of a run that dies are
+    # complete per unit. The category CSV, Parquet and Arrow files are exported from the store. Columns are
+    # named after the CSV columns, with INTEGER affinity for the counts, and columns added to categorized_fields
+    # or the summary later are added to existing stores. Count columns an older store created as TEXT stay text.
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA.format(
+                summary_columns=",\n    ".join(field + " INTEGER NOT NULL" for field in SUMMARY_FIELDS)))
+            existing = {row[1] for row in self.connection.execute("PRAGMA table_info(instances)")}
+            for field in INVENTORY_FIELDS:
+                if field not in existing:
+                    self.connection.execute("ALTER TABLE instances ADD COLUMN " + field +
+                                            (" INTEGER" if field in INTEGER_FIELDS else " TEXT"))
+            existing = {row[1] for row in self.connection.execute("PRAGMA table_info(account_summaries)")}
+            for field in SUMMARY_FIELDS:
+                if field not in existing:
+                    self.connection.execute("ALTER TABLE account_summaries ADD COLUMN " + field +
+                                            " INTEGER NOT NULL DEFAULT 0")
+            self.connection.executescript(INDEXES)
+        self.run_id = None
+        self.insert_statements = {
+            category: "INSERT INTO instances (run_id, seq, category, " + ", ".join(categorized_fields[category]) +
+                      ") VALUES (" + ", ".join(["?"] * (len(categorized_fields[category]) + 3)) + ")"
+            for category in CATEGORIES}
+
+    def start_run(self):
+        # Only one run writes a store at a time, so runs still "running" died before finishing them
+        with self.connection:
+            self.connection.execute("UPDATE runs SET status = 'failed' WHERE status = 'running'")
+            self.run_id = self.connection.execute("INSERT INTO runs (started, status) VALUES (?, 'running')",
+                                                  (get_timestamp(),)).lastrowid
+        return self.run_id
+
+    def write_unit(self, categorized_ec2_instances, seq):
+        # Every row of a unit gets the unit's index as seq, so units finishing in any order are read back in
+        # unit order, and the rows of a unit in the order they were inserted. Returns the categories written.
+        categories = []
+        with self.connection:
+            for category in CATEGORIES:
+                rows = [(self.run_id, seq, category) + tuple(record) for record in categorized_ec2_instances[category]]
+                if rows:
+                    self.connection.executemany(self.insert_statements[category], rows)
+                    categories.append(category)
+        return categories
+
+    def get_unit(self, seq, categories=CATEGORIES):
+        # Rows of one unit of the current run by category, in the order they were written
+        return {category: self.connection.execute(
+            "SELECT " + ", ".join(categorized_fields[category]) + " FROM instances WHERE run_id = ? AND "
+            "category = ? AND seq = ? ORDER BY rowid", (self.run_id, category, seq)).fetchall()
+            for category in categories}
+
+    def write_accounts(self, accounts, summary, error_messages):
+        # Final per-account counts and error messages of the run, once every finding is merged
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO account_summaries (run_id, AccountId, " + ", ".join(SUMMARY_FIELDS) +
+                ") VALUES (" + ", ".join(["?"] * (len(SUMMARY_FIELDS) + 2)) + ")",
+                [(self.run_id, account) + tuple(summary[account][field] for field in SUMMARY_FIELDS)
+                 for account in accounts])
+            self.connection.executemany(
+                "INSERT INTO errors (run_id, AccountId, error_type, message) VALUES (?, ?, ?, ?)",
+                [(self.run_id, account, error_type, message) for account in accounts
+                 for error_type, messages in error_messages[account].items() for message in messages])
+
+    def finish_run(self, status="complete"):
+        # Sampled runs finish as "sample" and sharded runs as "shard", so the latest_run view and the base run
+        # of the diffs are always full runs
+        with self.connection:
+            self.connection.execute("UPDATE runs SET finished = ?, status = ? WHERE run_id = ?",
+                                    (get_timestamp(), status, self.run_id))
+
+    def get_latest_run_id(self):
+        return self.connection.execute("SELECT run_id FROM latest_run").fetchone()[0]
+
+    def get_previous_run_id(self, run_id):
+        # Latest complete run before run_id
+        return self.connection.execute("SELECT MAX(run_id) FROM runs WHERE status = 'complete' AND run_id < ?",
+                                       (run_id,)).fetchone()[0]
+
+    def get_accounts(self, run_id):
+        # Accounts crawled in the run, whatever their errors
+        return {row[0] for row in self.connection.execute(
+            "SELECT AccountId FROM account_summaries WHERE run_id = ?", (run_id,))}
+
+    def get_accounts_with_errors(self, run_id):
+        # Accounts whose inventory is incomplete in the run: role assumption or an EC2 call failed
+        return {row[0] for row in self.connection.execute(
+            "SELECT AccountId FROM account_summaries WHERE run_id = ? AND (" + STS_ERRORS + " > 0 OR " +
+            EC2_ERRORS + " > 0)", (run_id,))}
+
+    def iterate_instance_range(self, run_id, columns, low=None, high=None):
+        # Instances of a run with low <= InstanceId < high (unbounded when None), read through the
+        # (run_id, InstanceId) index in batches
+        conditions = ["run_id = ?"]
+        parameters = [run_id]
+        if low is not None:
+            conditions.append("InstanceId >= ?")
+            parameters.append(low)
+        if high is not None:
+            conditions.append("InstanceId < ?")
+            parameters.append(high)
+        cursor = self.connection.execute("SELECT " + ", ".join(columns) + " FROM instances WHERE " +
+                                         " AND ".join(conditions) + " ORDER BY InstanceId", parameters)
+        for rows in fetch_batches(cursor):
+            yield from rows
+
+    def iterate_category(self, run_id, category):
+        # Rows of one category of a run in the order they were crawled, read in batches
+        cursor = self.connection.execute("SELECT " + ", ".join(categorized_fields[category]) +
+                                         " FROM instances WHERE run_id = ? AND category = ? ORDER BY seq, rowid",
+                                         (run_id, category))
+        return fetch_batches(cursor)
+
+    def iterate_columns(self, run_id, columns):
+        # Batches of some columns of every instance of a run, in no particular order
+        cursor = self.connection.execute("SELECT " + ", ".join(columns) + " FROM instances WHERE run_id = ?",
+                                         (run_id,))
+        return fetch_batches(cursor)
+
+    def export_categories(self, writer, run_id=None):
+        # Writes every category of a run through a CategoryCsvWriter or CategoryColumnarWriter
+        run_id = self.run_id if run_id is None else run_id
+        for category in CATEGORIES:
+            for rows in self.iterate_category(run_id, category):
+                writer.write_unit({category: rows})
+
+    def export_category_csvs(self, run_id=None):
+        with CategoryCsvWriter() as writer:
+            self.export_categories(writer, run_id)
+
+    def get_runs(self):
+        return self.connection.execute(
+            "SELECT runs.run_id, started, finished, status, COUNT(instances.run_id) FROM runs "
+            "LEFT JOIN instances ON instances.run_id = runs.run_id GROUP BY runs.run_id ORDER BY runs.run_id"
+        ).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main(command_line=None):
+    parser = argparse.ArgumentParser(description="Lists the runs kept in the inventory store and exports the "
+                                                 "category CSVs of any of them")
+    parser.add_argument("--store", default=DEFAULT_STORE_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("runs", help="List the stored runs")
+    export_parser = subparsers.add_parser("export", help="Write the category CSVs of a run")
+    export_parser.add_argument("--run-id", type=int, help="Defaults to the latest complete run")
+    export_parser.add_argument("--output-dir", default=".")
+    args = parser.parse_args(command_line)
+
+    with InventoryStore(os.path.abspath(args.store)) as store:
+        if args.command == "runs":
+            for run_id, started, finished, status, instances in store.get_runs():
+                print("%6d  %s  %-20s  %-8s  %d instances" % (run_id, started, finished or "", status, instances))
+            return
+        run_id = args.run_id if args.run_id is not None else store.get_latest_run_id()
+        if run_id is None:
+            print("No complete run in " + args.store)
+            return
+        os.makedirs(args.output_dir, exist_ok=True)
+        os.chdir(args.output_dir)
+        store.export_category_csvs(run_id)
+        print("Exported run " + str(run_id) + " to " + os.getcwd())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import random
+import threading
+import time
+from botocore.exceptions import ConnectionError as BotocoreConnectionError, HTTPClientError
+
+DEFAULT_REQUESTS_PER_SECOND = 20
+DEFAULT_MAX_ATTEMPTS = 8
+MIN_REQUESTS_PER_SECOND = 0.5
+BASE_RETRY_DELAY = 0.2
+MAX_RETRY_DELAY = 20
+
+THROTTLING_ERROR_CODES = {"Throttling", "ThrottlingException", "ThrottledException", "RequestThrottledException",
+                          "RequestLimitExceeded", "TooManyRequestsException", "RequestThrottled",
+                          "SlowDown", "EC2ThrottledException", "BandwidthLimitExceeded"}
+TRANSIENT_ERROR_CODES = {"RequestTimeout", "RequestTimeoutException", "PriorRequestNotComplete",
+                         "InternalError", "InternalFailure", "ServiceUnavailable", "Unavailable"}
+
+
+def get_error_code(error):
+    return getattr(error, "response", {}).get("Error", {}).get("Code")
+
+
+class TokenBucket:
+    # Client side token bucket whose refill rate adapts to throttling: it is halved on every throttling
+    # error and grows back additively with each successful call, up to the configured rate
+    def __init__(self, requests_per_second):
+        self.max_rate = requests_per_second
+        self.rate = requests_per_second
+        self.capacity = max(1.0, requests_per_second)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttle_events = 0
+        self.retries = 0
+        self.waited_seconds = 0.0
+        self.throttled_seconds = 0.0
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            self.requests += 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited_seconds += wait
+        if wait:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+    def on_throttled(self, delay):
+        with self.lock:
+            self.rate = max(MIN_REQUESTS_PER_SECOND, self.rate / 2)
+            self.throttle_events += 1
+            self.retries += 1
+            self.throttled_seconds += delay
+
+    def on_transient_error(self):
+        with self.lock:
+            self.retries += 1
+
+
+class RateLimiter:
+    # Token buckets keyed by (account, service, region). call() retries throttling and transient errors with
+    # exponential backoff and full jitter; other errors are raised to the caller at once.
+    def __init__(self, requests_per_second=DEFAULT_REQUESTS_PER_SECOND, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retry_listener=None):
+        self.requests_per_second = requests_per_second
+        self.max_attempts = max(1, max_attempts)
+        # Called with (key, operation) before every retry
+        self.retry_listener = retry_listener
+        self.buckets = dict()
+        self.lock = threading.Lock()
+
+    def get_bucket(self, key):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.requests_per_second)
+            return bucket
+
+    def call(self, key, operation, function, /, **kwargs):
+        bucket = self.get_bucket(key)
+        for attempt in range(self.max_attempts):
+            bucket.acquire()
+            try:
+                response = function(**kwargs)
+            except (BotocoreConnectionError, HTTPClientError):
+                if attempt == self.max_attempts - 1:
+                    raise
+                bucket.on_transient_error()
+                self.notify_retry(key, operation)
+                time.sleep(self.get_delay(attempt))
+                continue
+            except Exception as error:
+                error_code = get_error_code(error)
+                if attempt == self.max_attempts - 1 or (error_code not in THROTTLING_ERROR_CODES and
+                                                        error_code not in TRANSIENT_ERROR_CODES):
+                    raise
+                delay = self.get_delay(attempt)
+                if error_code in THROTTLING_ERROR_CODES:
+                    bucket.on_throttled(delay)
+                else:
+                    bucket.on_transient_error()
+                self.notify_retry(key, operation)
+                time.sleep(delay)
+                continue
+            bucket.on_success()
+            return response
+
+    def notify_retry(self, key, operation):
+        if self.retry_listener is not None:
+            self.retry_listener(key, operation)
+
+    @staticmethod
+    def get_delay(attempt):
+        return random.uniform(0, min(MAX_RETRY_DELAY, BASE_RETRY_DELAY * 2 ** attempt))
+
+    def get_report(self):
+        with self.lock:
+            buckets = sorted(self.buckets.items(), key=lambda item: tuple(str(part) for part in item[0]))
+        return [{"AccountId": account, "Service": service, "Region": region or "", "Requests": bucket.requests,
+                 "ThrottleEvents": bucket.throttle_events, "Retries": bucket.retries,
+                 "ThrottledSeconds": round(bucket.throttled_seconds, 3),
+                 "WaitedSeconds": round(bucket.waited_seconds, 3), "FinalRequestsPerSecond": round(bucket.rate, 3)}
+                for (account, service, region), bucket in buckets]
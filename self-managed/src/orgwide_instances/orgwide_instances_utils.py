@@ -1,6 +1,12 @@
 import boto3
+import heapq
+import random
+import threading
 import time
 import json
+from botocore.config import Config
+from orgwide_instances_org_cache import OrgMetadataCache, DEFAULT_ORG_CACHE_PATH
+from orgwide_instances_metrics import ApiMetrics
 
 # Constants
 TOTAL = "total"
@@ -11,60 +17,127 @@ TOTAL_ERRORS = "total_errors"
 STS_ERRORS = "sts_errors"
 EC2_ERRORS = "ec2_errors"
 SSM_ERRORS = "ssm_errors"
+BYOL_CORES = "byol_cores"
 STS_ERROR_MESSAGES = "sts_error_messages"
 EC2_ERROR_MESSAGES = "ec2_error_messages"
 SSM_ERROR_MESSAGES = "ssm_error_messages"
 
+# StackSet operation waiter: polls start after INITIAL_POLL_DELAY seconds and back off exponentially, with
+# jitter, up to MAX_POLL_DELAY; operations still running after POLL_DEADLINE seconds are reported as TIMED_OUT
+INITIAL_POLL_DELAY = 1
+MAX_POLL_DELAY = 30
+POLL_DEADLINE = 3600
+STACK_SET_OPERATION_IN_PROGRESS = ('QUEUED', 'RUNNING', 'STOPPING')
+
+# Organization metadata shared by every script in the process; see configure_org_cache
+org_cache = OrgMetadataCache()
+
+# API call metrics shared by every script in the process; management account clients are instrumented once,
+# when they are created, under MANAGEMENT_ACCOUNT
+api_metrics = ApiMetrics()
+# Rate limiter and metrics key of calls made with the management/delegated admin credentials
+MANAGEMENT_ACCOUNT = "management"
+
+# Management account clients keyed by (service, region, rate_limited), shared by every script in the process
+management_clients = dict()
+management_clients_lock = threading.Lock()
+# Clients whose every call goes through the aggregator's adaptive rate limiter have botocore retries disabled, as
+# the member account clients do, so throttling reaches the limiter and is reported in throttling.csv. The
+# others, e.g. the stack set calls of the role stages, keep botocore's default retries.
+RATE_LIMITED_CLIENT_CONFIG = Config(retries={"total_max_attempts": 1})
+
+# Column layout of each categorized CSV; lists keep the column order stable between runs
 categorized_fields = {
-    LICENSE_INCLUDED: {"AccountId", "PlatformDetails", "InstanceId", "Region", "LicenseIncludedType", "ImageId",
-                       "InstanceType", "InstanceStateName"},
-    MARKETPLACE: {"AccountId", "PlatformDetails", "InstanceId", "ProductCodes", "Region", "ImageId", "InstanceType",
-                  "InstanceStateName"},
-    BYOL: {"AccountId", "InstanceId", "PlatformDetails", "PlatformName", "PlatformType", "PlatformVersion", "Region",
-           "ImageId", "InstanceType", "InstanceStateName"}
+    LICENSE_INCLUDED: ["AccountId", "PlatformDetails", "InstanceId", "Region", "LicenseIncludedType", "ImageId",
+                       "InstanceType", "InstanceStateName", "VCpus"],
+    MARKETPLACE: ["AccountId", "PlatformDetails", "InstanceId", "ProductCodes", "Region", "ImageId", "InstanceType",
+                  "InstanceStateName", "VCpus"],
+    BYOL: ["AccountId", "InstanceId", "PlatformDetails", "PlatformName", "PlatformType", "PlatformVersion", "Region",
+           "ImageId", "InstanceType", "InstanceStateName", "VCpus", "CoreCount", "Sockets"]
 }
+# Columns holding counts, kept as integers by the inventory store and the Parquet and Arrow files
+INTEGER_FIELDS = ["VCpus", "CoreCount", "Sockets"]
 
 
-def get_current_account_id():
-    sts_client = get_sts_client()
-    sts_response = sts_client.get_caller_identity()
-    return sts_response["Account"]
+def configure_org_cache(inputs):
+    # Keeps organization metadata on disk between runs when "org_metadata_cache_ttl" is set (in seconds)
+    ttl = inputs.get("org_metadata_cache_ttl", 0)
+    if ttl > 0:
+        credentials = boto3.Session().get_credentials()
+        scope = credentials.access_key if credentials is not None else ""
+        org_cache.configure(inputs.get("org_metadata_cache_path", DEFAULT_ORG_CACHE_PATH), ttl, scope)
+    return org_cache
 
 
-def check_if_delegated_admin():
-    current_account = get_current_account_id()
+def get_current_account_id():
+    def load():
+        sts_client = get_sts_client()
+        sts_response = sts_client.get_caller_identity()
+        return sts_response["Account"]
+    return org_cache.get("caller_account", load)
 
-    org_client = get_org_client()
-    org_response = org_client.list_delegated_administrators(
-        ServicePrincipal='member.org.stacksets.cloudformation.amazonaws.com')
 
-    if any([current_account == da["Id"] for da in org_response["DelegatedAdministrators"]]):
-        return 'DELEGATED_ADMIN'
-    return 'SELF'
+def check_if_delegated_admin():
+    def load():
+        current_account = get_current_account_id()
+
+        org_client = get_org_client()
+        org_response = org_client.list_delegated_administrators(
+            ServicePrincipal='member.org.stacksets.cloudformation.amazonaws.com')
+
+        if any([current_account == da["Id"] for da in org_response["DelegatedAdministrators"]]):
+            return 'DELEGATED_ADMIN'
+        return 'SELF'
+    return org_cache.get("delegated_admin", load)
+
+
+def get_roots():
+    return org_cache.get("roots", lambda: get_org_client().list_roots()["Roots"])
+
+
+def get_poll_delay(attempt):
+    delay = min(MAX_POLL_DELAY, INITIAL_POLL_DELAY * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def wait_for_stack_set_operations(caller, cf_client, operation_ids, stack_set_name, deadline=POLL_DEADLINE,
+                                  describe_operation=None):
+    # Waits on several StackSet operations at once and yields (operation_id, status) as each one finishes.
+    # Every operation is polled on its own backoff schedule, so a finished operation is seen within a
+    # fraction of its current poll interval instead of on a fixed 10 second tick.
+    describe_operation = describe_operation or cf_client.describe_stack_set_operation
+    start = time.monotonic()
+    pending = [(start, index, operation_id, 0) for index, operation_id in enumerate(operation_ids)]
+    heapq.heapify(pending)
+    while pending:
+        poll_time, index, operation_id, attempt = heapq.heappop(pending)
+        now = time.monotonic()
+        if poll_time - start > deadline:
+            yield operation_id, 'TIMED_OUT'
+            continue
+        if poll_time > now:
+            time.sleep(poll_time - now)
+        cf_response = describe_operation(StackSetName=stack_set_name,
+                                         OperationId=operation_id,
+                                         CallAs=caller)
+        status = cf_response["StackSetOperation"]["Status"]
+        if status in STACK_SET_OPERATION_IN_PROGRESS:
+            heapq.heappush(pending, (time.monotonic() + get_poll_delay(attempt), index, operation_id, attempt + 1))
+        else:
+            yield operation_id, status
 
 
 def polling(caller, cf_client, operation_id, stack_set_name):
-    cf_response = cf_client.describe_stack_set_operation(StackSetName=stack_set_name,
-                                                         OperationId=operation_id,
-                                                         CallAs=caller)
-    while (cf_response["StackSetOperation"]["Status"] == 'QUEUED' or
-           cf_response["StackSetOperation"]["Status"] == 'RUNNING'):
-        time.sleep(10)
-        cf_response = cf_client.describe_stack_set_operation(StackSetName=stack_set_name,
-                                                             OperationId=operation_id,
-                                                             CallAs=caller)
-    if cf_response["StackSetOperation"]["Status"] != 'SUCCEEDED':
-        return False
-    return True
+    for _, status in wait_for_stack_set_operations(caller, cf_client, [operation_id], stack_set_name):
+        return status == 'SUCCEEDED'
 
 
 def get_deployment_targets(input_ou_ids, input_accounts, operation):
-    orgs_client = get_org_client()
-    orgs_response = orgs_client.list_roots()
-    ou_ids = [root["Id"] for root in orgs_response["Roots"]]
+    roots = get_roots()
+    ou_ids = [root["Id"] for root in roots]
     if len(input_accounts) == 0 and len(input_ou_ids) == 0:
         print("Deploying stack instance " + operation + " in following OU Ids: ")
-        for root in orgs_response["Roots"]:
+        for root in roots:
             print(root["Id"])
         return {"OrganizationalUnitIds": ou_ids}
     deployment_targets = dict()
@@ -88,14 +161,26 @@ def get_inputs():
         return json.load(fp)
 
 
-def get_org_client():
-    return boto3.client(service_name='organizations')
+def get_management_client(service, region=None, rate_limited=False):
+    # Clients are thread safe, so one per service and region is created and reused. rate_limited clients must
+    # only be called through the aggregator's rate limiter, since botocore does not retry them.
+    key = (service, region, rate_limited)
+    with management_clients_lock:
+        client = management_clients.get(key)
+        if client is None:
+            client = boto3.client(service_name=service, region_name=region,
+                                  config=RATE_LIMITED_CLIENT_CONFIG if rate_limited else None)
+            client = management_clients[key] = api_metrics.register(client, MANAGEMENT_ACCOUNT, region)
+        return client
+
+
+def get_org_client(rate_limited=False):
+    return get_management_client('organizations', rate_limited=rate_limited)
 
 
-def get_cf_client(region):
-    return boto3.client(service_name='cloudformation',
-                        region_name=region)
+def get_cf_client(region, rate_limited=False):
+    return get_management_client('cloudformation', region, rate_limited)
 
 
 def get_sts_client():
-    return boto3.client(service_name='sts')
\ No newline at end of file
+    return get_management_client('sts')
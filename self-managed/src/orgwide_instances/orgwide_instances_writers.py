@@ -0,0 +1,30 @@
+import csv
+from orgwide_instances_utils import LICENSE_INCLUDED, MARKETPLACE, BYOL, categorized_fields
+
+
+class CategoryCsvWriter:
+    # Appends records to license_included.csv, marketplace.csv and byol.csv, one batch (e.g. the records of an
+    # (account, region) unit) at a time, flushing after every batch
+    def __init__(self, categories=(LICENSE_INCLUDED, BYOL, MARKETPLACE)):
+        self.files = dict()
+        self.writers = dict()
+        for key in categories:
+            self.files[key] = open(key + ".csv", 'w', newline='')
+            self.writers[key] = csv.writer(self.files[key])
+            self.writers[key].writerow(categorized_fields[key])
+
+    def write_unit(self, categorized_ec2_instances):
+        for key, records in categorized_ec2_instances.items():
+            self.writers[key].writerows(records)
+        for file in self.files.values():
+            file.flush()
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()